@@ -49,7 +49,8 @@ def main(args):
     )
     # set bs = 1, and disable shuffle
     val_loader = make_data_loader(
-        val_dataset, False, None, 1, cfg['loader']['num_workers']
+        val_dataset, False, None, 1, cfg['loader']['num_workers'],
+        cfg['loader']['pin_memory'], cfg['loader']['prefetch_factor']
     )
 
     """3. create model and evaluator"""
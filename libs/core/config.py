@@ -36,6 +36,12 @@ DEFAULTS = {
     "loader": {
         "batch_size": 8,
         "num_workers": 4,
+        # pin the host memory of the batches (faster H2D copies)
+        "pin_memory": False,
+        # number of batches loaded in advance by each worker
+        "prefetch_factor": 2,
+        # if to batch training samples of similar lengths (use with train_cfg.pad_to_max_seq_len=False)
+        "length_bucket": False,
     },
     # network architecture
     "model": {
@@ -89,7 +95,9 @@ DEFAULTS = {
         # add gaussian noise with the variance, play a similar role to position embedding
         "input_noise": 0,
         "multi_label": False,
-        "additional_only": False
+        "additional_only": False,
+        # if to compile the backbone with torch.compile (needs torch >= 2.0)
+        "use_compile": False
     },
     "train_cfg": {
         # radius | none (if to use center sampling)
@@ -108,6 +116,8 @@ DEFAULTS = {
         "droppath": 0.1,
         # if to use label smoothing (>0.0)
         "label_smoothing": 0.0,
+        # if false, pad a training batch to its longest sample (rounded up to max_div_factor)
+        "pad_to_max_seq_len": True,
     },
     "test_cfg": {
         "pre_nms_thresh": 0.001,
@@ -121,6 +131,11 @@ DEFAULTS = {
         "multiclass_nms": True,
         "ext_score_file": None,
         "voting_thresh": 0.75,
+        # if to pad long inputs to max_seq_len x 2^k instead of the next divisible size
+        # (fewer distinct shapes for compiled models, but the padding changes the outputs)
+        "pad_to_buckets": False,
+        # if to run the heads in reduced precision (fp16 on GPUs, bf16 on CPUs), faster but less accurate
+        "head_autocast": False,
     },
     # optimizer (for training)
     "opt": {
@@ -21,8 +21,50 @@ def worker_init_reset_seed(worker_id):
     random.seed(seed)
     os.environ["PYTHONHASHSEED"] = str(seed)
 
-def truncate_feats(
-        data_dict,
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+        A batch sampler that groups samples of similar lengths (within about +/- bucket_ratio),
+        so that less padding is needed when a batch is padded to its longest sample.
+        Lengths are jittered before sorting, and the order of the batches is shuffled every epoch.
+    """
+    def __init__(self, seq_lens, batch_size, generator=None, bucket_ratio=0.1, drop_last=True):
+        self.seq_lens = torch.as_tensor(seq_lens, dtype=torch.float32)
+        self.batch_size = batch_size
+        self.generator = generator
+        self.bucket_ratio = bucket_ratio
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.seq_lens) // self.batch_size
+        return (len(self.seq_lens) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        # sort by the jittered lengths, then cut into batches
+        jitter = torch.rand(len(self.seq_lens), generator=self.generator) * 2 - 1
+        keys = self.seq_lens * (1 + self.bucket_ratio * jitter)
+        batches = list(torch.argsort(keys).split(self.batch_size))
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        for idx in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[idx].tolist()
+
+def to_worker_output(x, dtype=torch.float32):
+    """
+        Cast x into a contiguous tensor of dtype.
+        Within a dataloader worker, the output is allocated in shared memory (as in
+        default_collate), so that it is not copied again when sent to the main process
+    """
+    if torch.utils.data.get_worker_info() is None:
+        return x.to(dtype, memory_format=torch.contiguous_format).contiguous()
+    storage = torch.empty(0, dtype=dtype)._typed_storage()._new_shared(x.numel(), device='cpu')
+    out = torch.empty(0, dtype=dtype).new(storage).view(x.shape)
+    out.copy_(x)
+    return out
+
+def sample_truncation_window(
+        feat_len,
+        segments,
         max_seq_len,
         trunc_thresh,
         crop_ratio=None,
@@ -31,26 +73,21 @@ def truncate_feats(
         no_trunc=False
 ):
     """
-    Truncate feats and time stamps in a dict item
+    Sample a random truncation window of the feats (before loading them)
 
-    data_dict = {'video_id'        : str
-                 'feats'           : Tensor C x T
-                 'segments'        : Tensor N x 2 (in feature grid)
-                 'labels'          : Tensor N
-                 'fps'             : float
-                 'feat_stride'     : int
-                 'feat_num_frames' : in
+    feat_len: length of the feats (in feature grids)
+    segments: Tensor N x 2 (in feature grids)
 
+    Return None if no truncation is needed, otherwise (st, ed, segments, seg_idx)
+    with the kept (shifted) segments and their indices
     """
-    # get the meta info
-    feat_len = data_dict['feats'].shape[1]
-    num_segs = data_dict['segments'].shape[0]
+    num_segs = segments.shape[0]
 
     # seq_len < max_seq_len
     if feat_len <= max_seq_len:
         # do nothing
         if crop_ratio == None:
-            return data_dict
+            return None
         # randomly crop the seq by setting max_seq_len to a value in [l, r]
         else:
             max_seq_len = random.randint(
@@ -59,10 +96,7 @@ def truncate_feats(
             )
             # # corner case
             if feat_len == max_seq_len:
-                return data_dict
-
-    # otherwise, deep copy the dict
-    data_dict = copy.deepcopy(data_dict)
+                return None
 
     # try a few times till a valid truncation with at least one action
     for _ in range(max_num_trials):
@@ -74,11 +108,10 @@ def truncate_feats(
 
         # compute the intersection between the sampled window and all segments
         window = window[None].repeat(num_segs, 1)
-        left = torch.maximum(window[:, 0], data_dict['segments'][:, 0])
-        right = torch.minimum(window[:, 1], data_dict['segments'][:, 1])
+        left = torch.maximum(window[:, 0], segments[:, 0])
+        right = torch.minimum(window[:, 1], segments[:, 1])
         inter = (right - left).clamp(min=0)
-        area_segs = torch.abs(
-            data_dict['segments'][:, 1] - data_dict['segments'][:, 0])
+        area_segs = torch.abs(segments[:, 1] - segments[:, 0])
         inter_ratio = inter / area_segs
 
         # only select those segments over the thresh
@@ -99,14 +132,49 @@ def truncate_feats(
             # without any constraints
             break
 
+    # segments: N x 2 in feature grids, shift the time stamps due to truncation
+    segments = torch.stack((left[seg_idx], right[seg_idx]), dim=1) - st
+
+    return st, ed, segments, seg_idx
+
+def truncate_feats(
+        data_dict,
+        max_seq_len,
+        trunc_thresh,
+        crop_ratio=None,
+        max_num_trials=200,
+        has_action=True,
+        no_trunc=False
+):
+    """
+    Truncate feats and time stamps in a dict item
+
+    data_dict = {'video_id'        : str
+                 'feats'           : Tensor C x T
+                 'segments'        : Tensor N x 2 (in feature grid)
+                 'labels'          : Tensor N
+                 'fps'             : float
+                 'feat_stride'     : int
+                 'feat_num_frames' : in
+
+    """
+    window = sample_truncation_window(
+        data_dict['feats'].shape[1], data_dict['segments'], max_seq_len, trunc_thresh,
+        crop_ratio, max_num_trials, has_action, no_trunc
+    )
+    if window is None:
+        return data_dict
+    st, ed, segments, seg_idx = window
+
+    # otherwise, copy the dict (no need to deep copy the feats, they are sliced below)
+    data_dict = copy.copy(data_dict)
+
     # feats: C x T
     data_dict['feats'] = data_dict['feats'][:, st:ed].clone()
     if 'additional_feats' in  data_dict.keys() and data_dict['additional_feats'] is not None:
         data_dict['additional_feats'] = data_dict['additional_feats'][:, st:ed].clone()
     # segments: N x 2 in feature grids
-    data_dict['segments'] = torch.stack((left[seg_idx], right[seg_idx]), dim=1)
-    # shift the time stamps due to truncation
-    data_dict['segments'] = data_dict['segments'] - st
+    data_dict['segments'] = segments
     # labels: N
     data_dict['labels'] = data_dict['labels'][seg_idx].clone()
 
@@ -1,6 +1,6 @@
 import os
 import torch
-from .data_utils import trivial_batch_collator, worker_init_reset_seed
+from .data_utils import trivial_batch_collator, worker_init_reset_seed, LengthBucketBatchSampler
 
 datasets = {}
 def register_dataset(name):
@@ -16,19 +16,28 @@ def make_dataset(name, is_training, split, **kwargs):
    dataset = datasets[name](is_training, split, **kwargs)
    return dataset
 
-def make_data_loader(dataset, is_training, generator, batch_size, num_workers):
+def make_data_loader(dataset, is_training, generator, batch_size, num_workers,
+                     pin_memory=False, prefetch_factor=2, length_bucket=False):
     """
         A simple dataloder builder
     """
+    # prefetch_factor is only valid with worker processes
+    extra_args = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+    if is_training and length_bucket:
+        # batch samples of similar lengths (the dataset must provide seq_lens)
+        assert hasattr(dataset, 'seq_lens'), "Length bucketing is not supported by the dataset"
+        extra_args['batch_sampler'] = LengthBucketBatchSampler(
+            dataset.seq_lens, batch_size, generator=generator)
+    else:
+        extra_args.update({'batch_size': batch_size, 'shuffle': is_training,
+                           'drop_last': is_training, 'generator': generator})
     loader = torch.utils.data.DataLoader(
         dataset,
-        batch_size=batch_size,
         num_workers=num_workers,
         collate_fn=trivial_batch_collator,
         worker_init_fn=(worker_init_reset_seed if is_training else None),
-        shuffle=is_training,
-        drop_last=is_training,
-        generator=generator,
-        persistent_workers=True
+        persistent_workers=True,
+        pin_memory=pin_memory,
+        **extra_args
     )
     return loader
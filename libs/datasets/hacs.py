@@ -1,6 +1,11 @@
 import os
 import json
+import hashlib
 import h5py
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import numpy as np
 
 import torch
@@ -8,7 +13,7 @@ from torch.utils.data import Dataset
 from torch.nn import functional as F
 
 from .datasets import register_dataset
-from .data_utils import truncate_feats
+from .data_utils import sample_truncation_window, to_worker_output
 from ..utils import remove_duplicate_annotations
 
 
@@ -33,7 +38,9 @@ class HacsDataset(Dataset):
             file_ext,  # feature file extension if any
             force_upsampling,  # force to upsample to max_seq_len
             backbone_type,  # feat_type
-            additional_feat_folder=None
+            additional_feat_folder=None,
+            cache_dir=None,  # folder to cache the decoded feats if any
+            transport_dtype='float32'  # dtype of the returned feats, upcast on GPU
     ):
         # todo file path, make it general
         if backbone_type == 'slowfast':
@@ -70,6 +77,10 @@ class HacsDataset(Dataset):
         self.crop_ratio = crop_ratio
         self.use_addtional_feats = additional_feat_folder is not None
         self.additional_feat_folder = additional_feat_folder
+        self.cache_dir = cache_dir
+        self.transport_dtype = getattr(torch, transport_dtype)
+        # h5 file handle, opened lazily (once per worker process)
+        self._h5 = None
 
         # load database and select the subset
         dict_db, label_dict = self._load_json_db(self.json_file)
@@ -77,6 +88,23 @@ class HacsDataset(Dataset):
         assert (num_classes == 1) or (len(label_dict) == num_classes)
         self.data_list = dict_db
         self.label_dict = label_dict
+        self._pack_annotations()
+        # estimated feature length of each video (used for length bucketed batching)
+        self.seq_lens = self._estimate_seq_lens()
+
+        # feats are decoded once on their first access, later epochs only memory-map the cached arrays
+        # the cache is namespaced by the feat source, as several feat types share the same video ids
+        if self.cache_dir is not None:
+            self.feat_cache_dir = self._cache_subdir(
+                self.backbone_type, self.backbone_type, os.path.realpath(self.feat_folder),
+                self.file_prefix, self.file_ext
+            )
+            os.makedirs(self.feat_cache_dir, exist_ok=True)
+            if self.use_addtional_feats:
+                self.add_cache_dir = self._cache_subdir(
+                    'add', os.path.realpath(self.additional_feat_folder), self.file_prefix
+                )
+                os.makedirs(self.add_cache_dir, exist_ok=True)
 
         # dataset specific attributes
         self.db_attributes = {
@@ -91,8 +119,13 @@ class HacsDataset(Dataset):
 
     def _load_json_db(self, json_file):
         # load database and select the subset
-        with open(json_file, 'r') as fid:
-            json_data = json.load(fid)
+        # orjson is much faster on the large HACS json, fall back to json if missing
+        if orjson is not None:
+            with open(json_file, 'rb') as fid:
+                json_data = orjson.loads(fid.read())
+        else:
+            with open(json_file, 'r') as fid:
+                json_data = json.load(fid)
         json_db = json_data['database']
 
         # if label_dict is not available
@@ -103,7 +136,7 @@ class HacsDataset(Dataset):
                     label_dict[act['label']] = act['label_id']
 
         # fill in the db (immutable afterwards)
-        dict_db = tuple()
+        dict_db = []
         for key, value in json_db.items():
             # skip the video if not in the split
             if value['subset'].lower() not in self.split:
@@ -122,64 +155,206 @@ class HacsDataset(Dataset):
             if ('annotations' in value) and (len(value['annotations']) > 0):
                 valid_acts = remove_duplicate_annotations(value['annotations'])
                 num_acts = len(valid_acts)
-                segments = np.zeros([num_acts, 2], dtype=np.float32)
-                labels = np.zeros([num_acts, ], dtype=np.int64)
-                for idx, act in enumerate(valid_acts):
-                    segments[idx][0] = act['segment'][0]
-                    segments[idx][1] = act['segment'][1]
-                    if self.num_classes == 1:
-                        labels[idx] = 0
-                    else:
-                        labels[idx] = label_dict[act['label']]
+                # build the arrays in one go instead of filling them element by element
+                segments = np.array(
+                    [(act['segment'][0], act['segment'][1]) for act in valid_acts], dtype=np.float32
+                ).reshape(num_acts, 2)
+                if self.num_classes == 1:
+                    labels = np.zeros([num_acts, ], dtype=np.int64)
+                else:
+                    labels = np.array([label_dict[act['label']] for act in valid_acts], dtype=np.int64)
             else:
                 segments = None
                 labels = None
-            dict_db += ({'id': key,
-                         'fps': fps,
-                         'duration': duration,
-                         'segments': segments,
-                         'labels': labels
-                         },)
 
-        return dict_db, label_dict
+            # var length feats have a fixed grid, convert the time stamps only once
+            grid_segments = None
+            if (segments is not None) and self.feat_stride > 0 and (not self.force_upsampling):
+                feat_stride = self.feat_stride
+                if self.downsample_rate > 1:
+                    feat_stride = self.feat_stride * self.downsample_rate
+                grid_segments = (segments * fps - 0.5 * self.num_frames) / feat_stride
 
-    def __len__(self):
-        return len(self.data_list)
+            dict_db.append({'id': key,
+                            'fps': fps,
+                            'duration': duration,
+                            'segments': segments,
+                            'grid_segments': grid_segments,
+                            'labels': labels
+                            })
 
-    def __getitem__(self, idx):
-        # directly return a (truncated) data point (so it is very fast!)
-        # auto batching will be disabled in the subsequent dataloader
-        # instead the model will need to decide how to batch / preporcess the data
-        video_item = self.data_list[idx]
+        return tuple(dict_db), label_dict
+
+    def _pack_annotations(self):
+        # flatten the annotations of all videos into a few shared tensors indexed by per-video offsets,
+        # so that the workers do not copy (or touch) thousands of small per-video arrays
+        num_acts = [0 if x['segments'] is None else x['segments'].shape[0] for x in self.data_list]
+        offsets = np.zeros([len(num_acts) + 1, ], dtype=np.int64)
+        np.cumsum(num_acts, out=offsets[1:])
+
+        def _concat(key, shape, dtype):
+            arrays = [x[key] for x in self.data_list if x[key] is not None]
+            if len(arrays) == 0:
+                return torch.from_numpy(np.zeros(shape, dtype=dtype)).share_memory_()
+            return torch.from_numpy(np.concatenate(arrays)).share_memory_()
+
+        self._ann_offsets = offsets.tolist()
+        self._ann_segments = _concat('segments', [0, 2], np.float32)
+        self._ann_labels = _concat('labels', [0, ], np.int64)
+        # grid segments are either available for all videos or none of them
+        has_grid = any(x['grid_segments'] is not None for x in self.data_list)
+        self._ann_grid_segments = _concat('grid_segments', [0, 2], np.float32) if has_grid else None
+
+        # only keep the meta info in the per-video dicts
+        self.data_list = tuple(
+            {k: v for k, v in x.items() if k not in ('segments', 'grid_segments', 'labels')}
+            for x in self.data_list
+        )
+
+    def _estimate_seq_lens(self):
+        # fixed length / resized feats are assumed to be of max_seq_len
+        if self.feat_stride <= 0 or self.force_upsampling:
+            return [self.max_seq_len] * len(self.data_list)
+        feat_stride = self.feat_stride * max(self.downsample_rate, 1)
+        # long videos are truncated to max_seq_len during training
+        return [
+            min(max(int(x['duration'] * x['fps'] / feat_stride), 1), self.max_seq_len)
+            for x in self.data_list
+        ]
 
+    def __getstate__(self):
+        # never pickle the h5 handle to the workers, each worker opens its own
+        state = self.__dict__.copy()
+        state['_h5'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _cache_subdir(self, name, *source):
+        # <cache_dir>/<name>-<short hash of the source>
+        key = hashlib.sha1(repr(source).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, '{:s}-{:s}'.format(name, key))
+
+    def _cache_file(self, video_id):
+        return os.path.join(self.feat_cache_dir, video_id + '.npy')
+
+    def _save_cache(self, cache_file, array):
+        # write to a tmp file and rename, as several workers may miss the same video
+        tmp_file = '{:s}.{:d}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as fid:
+            np.save(fid, array)
+        os.replace(tmp_file, cache_file)
+
+    def _load_cached_feats(self, video_item):
+        # the decoded feats (e.g., slowfast concat + transpose) are stored as a contiguous T x C float32 array
+        cache_file = self._cache_file(video_item['id'])
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+        feats = np.ascontiguousarray(self._load_raw_feats(video_item))
+        self._save_cache(cache_file, feats)
+        return feats
+
+    def _load_additional_feats(self, video_item, feat_len):
+        # load the additional feats resized to feat_len, return a D x T float32 tensor
+        # the resized feats only depend on the file and feat_len, so they are cached (per source) if possible
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.add_cache_dir, '{:s}.{:d}.npy'.format(video_item['id'], feat_len))
+            if os.path.exists(cache_file):
+                return torch.from_numpy(np.load(cache_file))
+
+        additional_file_name = self.file_prefix + video_item['id'] + '.npy'
+        # T, kpt_cls, height, width / T, dim
+        additional_feats = self._load_npy(os.path.join(self.additional_feat_folder, additional_file_name))
+        additional_feats = torch.from_numpy(self._read_rows(additional_feats, slice(None)))
+
+        additional_feats = additional_feats.flatten(1)  # T, cls, height* width
+        additional_feats = additional_feats.transpose(0, 1)  # cls*height* width, T
+        # a trick: make the interpolation determinant
+        additional_feats = \
+            F.interpolate(additional_feats[None], feat_len, mode='linear', align_corners=True)[0]
+
+        if self.cache_dir is not None:
+            self._save_cache(cache_file, additional_feats.numpy())
+        return additional_feats
+
+    @staticmethod
+    def _load_npy(filename):
+        # plain arrays are memory-mapped (no full read), only object arrays need pickle
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            return np.load(filename, allow_pickle=True)
+
+    @staticmethod
+    def _read_rows(feats, rows):
+        # materialize the rows of an array / h5 dataset / memmap as a writable float32 array
+        feats = np.asarray(feats[rows], dtype=np.float32)
+        if not feats.flags.writeable:
+            feats = np.array(feats)
+        return feats
+
+    def _h5_dataset(self, video_item):
+        # keep the file open across samples, with a larger chunk cache
+        if self._h5 is None:
+            self._h5 = h5py.File(
+                self.feat_folder, 'r', libver='latest', swmr=True, rdcc_nbytes=64 << 20
+            )
+        return self._h5[video_item['id']]
+
+    def _open_feats(self, video_item):
+        # T x C feats, an h5 dataset / memory-mapped cache is only read when sliced
+        if self.cache_dir is not None:
+            return self._load_cached_feats(video_item)
+        if self.backbone_type == 'i3d':
+            return self._h5_dataset(video_item)
+        return self._load_raw_feats(video_item)
+
+    def _load_raw_feats(self, video_item):
+        # decode the feats from the original files, return a T x C float32 array (possibly a strided view)
         # todo load features, make it general
         if self.backbone_type == 'i3d':
-            with h5py.File(self.feat_folder, 'r') as h5_fid:
-                feats = np.asarray(
-                    h5_fid[video_item['id']][()],
-                    dtype=np.float32
-                )
+            feats = np.asarray(
+                self._h5_dataset(video_item)[()],
+                dtype=np.float32
+            )
         elif self.backbone_type == 'slowfast':
             filename = os.path.join(self.feat_folder, video_item['id'] + self.file_ext)
             feats = np.load(filename, allow_pickle=True)
             # 1 x 2304 x T --> T x 2304
             feats = torch.concat([feats['slow_feature'], feats['fast_feature']], dim=1).squeeze(0).transpose(0, 1)
+            feats = feats.numpy()
         elif self.backbone_type == 'tsp' or self.backbone_type == 'pose':
             filename = os.path.join(self.feat_folder, self.file_prefix + video_item['id'] + self.file_ext)
-            feats = np.load(filename, allow_pickle=True).astype(np.float32)
+            feats = self._load_npy(filename)
         elif self.backbone_type == 'videomaev2':
             filename = os.path.join(self.feat_folder, self.file_prefix + video_item['id'] + self.file_ext)
             # feats = torch.load(filename)
-            feats = np.load(filename, allow_pickle=True).astype(np.float32)
+            feats = self._load_npy(filename)
             # 100 x 1408
 
+        return np.asarray(feats, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.data_list)
+
+    def __getitem__(self, idx):
+        # directly return a (truncated) data point (so it is very fast!)
+        # auto batching will be disabled in the subsequent dataloader
+        # instead the model will need to decide how to batch / preporcess the data
+        video_item = self.data_list[idx]
+
+        # T x C feats, not read yet if they are stored in an h5 file or cached
+        feats = self._open_feats(video_item)
+
         # we support both fixed length features / variable length features
+        ds_rate = 1
         if self.feat_stride > 0 and (not self.force_upsampling):
             # var length features
             feat_stride, num_frames = self.feat_stride, self.num_frames
             # only apply down sampling here
             if self.downsample_rate > 1:
-                feats = feats[::self.downsample_rate, :]
+                ds_rate = self.downsample_rate
                 feat_stride = self.feat_stride * self.downsample_rate
         # case 2: variable length features for input, yet resized for training
         elif self.feat_stride > 0 and self.force_upsampling:
@@ -199,69 +374,77 @@ class HacsDataset(Dataset):
             feat_stride = video_item['duration'] * video_item['fps'] / seq_len
             # center the features
             num_frames = feat_stride
-
-        # T x C -> C x T
-        if isinstance(feats, torch.Tensor):
-            feats = feats.transpose(0, 1)
-        else:
-            feats = torch.from_numpy(np.ascontiguousarray(feats.transpose()))
+        # number of feats after downsampling
+        num_feats = (feats.shape[0] + ds_rate - 1) // ds_rate
 
         # resize the features if needed
-        if (feats.shape[-1] != self.max_seq_len) and self.force_upsampling:
-            resize_feats = F.interpolate(
-                feats.unsqueeze(0),
-                size=self.max_seq_len,
-                mode='linear',
-                align_corners=False
-            )
-            feats = resize_feats.squeeze(0)
+        # the resize is deferred to the model (on GPU) unless we need to crop the resized feats
+        target_len, resize_feats = None, False
+        if (num_feats != self.max_seq_len) and self.force_upsampling:
+            if self.is_training and (self.crop_ratio is not None):
+                resize_feats = True
+            else:
+                target_len = self.max_seq_len
+        # length of the feats seen by the model
+        feat_len = self.max_seq_len if self.force_upsampling else num_feats
 
         if self.use_addtional_feats:
-
-            additional_file_name = self.file_prefix + video_item['id'] + '.npy'
-            # T, kpt_cls, height, width / T, dim
-            additional_feats = np.load(os.path.join(self.additional_feat_folder, additional_file_name),
-                                       allow_pickle=True)
-            additional_feats = torch.from_numpy(additional_feats).to(torch.float32)
-
-            # todo vector
-            additional_feats = additional_feats.flatten(1)  # T, cls, height* width
-            additional_feats = additional_feats.transpose(0, 1)  # cls*height* width, T
-            # a trick: make the interpolation determinant
-            additional_feats = \
-                F.interpolate(additional_feats[None], feats.shape[-1], mode='linear', align_corners=True)[0]
+            additional_feats = self._load_additional_feats(video_item, feat_len)
         else:
             additional_feats = None
 
         # convert time stamp (in second) into temporal feature grids
         # ok to have small negative values here
-        if video_item['segments'] is not None:
-            segments = torch.from_numpy(
-                (video_item['segments'] * video_item['fps'] - 0.5 * num_frames) / feat_stride
-            )
-            labels = torch.from_numpy(video_item['labels'])
+        st, ed = self._ann_offsets[idx], self._ann_offsets[idx + 1]
+        if ed > st:
+            # copy the slices, the returned tensors must not alias the shared annotations
+            if self._ann_grid_segments is not None:
+                segments = self._ann_grid_segments[st:ed].numpy().copy()
+            else:
+                segments = (self._ann_segments[st:ed].numpy() * video_item['fps'] - 0.5 * num_frames) / feat_stride
+            labels = self._ann_labels[st:ed].numpy().copy()
             # for activity net, we have a few videos with a bunch of missing frames
             # here is a quick fix for training
             if self.is_training:
-                feat_len = feats.shape[1]
-                valid_seg_list, valid_label_list = [], []
-                for seg, label in zip(segments, labels):
-                    if seg[0] >= feat_len:
-                        # skip an action outside of the feature map
-                        continue
-                    # truncate an action boundary
-                    valid_seg_list.append(seg.clamp(min=0, max=feat_len))
-                    # some weird bug here if not converting to size 1 tensor
-                    valid_label_list.append(label.view(1))
-                if len(valid_seg_list) == 0:
-                    # print(feat_len, segments, video_item)
-                    segments, labels = None, None
-                else:
-                    segments = torch.stack(valid_seg_list, dim=0)
-                    labels = torch.cat(valid_label_list)
+                # skip actions outside of the feature map and truncate the action boundaries
+                valid = segments[:, 0] < feat_len
+                segments = np.clip(segments[valid], 0, feat_len)
+                labels = labels[valid]
+            if segments.shape[0] == 0:
+                segments, labels = None, None
+            else:
+                segments = torch.from_numpy(segments)
+                labels = torch.from_numpy(labels)
         else:
             segments, labels = None, None
 
+        # sample the truncation window during training before reading the feats,
+        # so that only the needed slice is read (resized feats never need truncation)
+        st, ed, window = 0, (feat_len if target_len is None else num_feats), None
+        if self.is_training and (segments is not None) and (target_len is None):
+            window = sample_truncation_window(
+                feat_len, segments, self.max_seq_len, self.trunc_thresh, self.crop_ratio
+            )
+            if window is not None:
+                st, ed, segments, seg_idx = window
+                labels = labels[seg_idx]
+
+        # read the feats, T x C -> C x T as a stride-only view (made contiguous once before leaving the worker)
+        if resize_feats:
+            feats = torch.from_numpy(self._read_rows(feats, slice(None))).transpose(0, 1)
+            feats = F.interpolate(
+                feats.unsqueeze(0),
+                size=self.max_seq_len,
+                mode='linear',
+                align_corners=False
+            ).squeeze(0)[:, st:ed]
+        else:
+            # a memory-mapped / h5 slice is materialized here
+            feats = self._read_rows(feats, slice(st * ds_rate, ed * ds_rate, ds_rate))
+            feats = torch.from_numpy(feats).transpose(0, 1)
+        if (additional_feats is not None) and (window is not None):
+            additional_feats = additional_feats[:, st:ed]
+
         # return a data dict
         data_dict = {'video_id': video_item['id'],
                      'feats': feats,  # C x T
@@ -272,13 +455,13 @@ class HacsDataset(Dataset):
                      'feat_stride': feat_stride,
                      'feat_num_frames': num_frames,
                      'additional_feats': additional_feats,
+                     'target_len': target_len,  # resize the feats to this length if not None
                      }
 
-        # no truncation is needed
-        # truncate the features during training
-        if self.is_training and (segments is not None):
-            data_dict = truncate_feats(
-                data_dict, self.max_seq_len, self.trunc_thresh, self.crop_ratio
-            )
+        # smaller tensors through the worker queue, the model casts them back to fp32
+        # only plain contiguous tensors leave the worker (no memmap / h5 refs), so they can be pinned
+        data_dict['feats'] = to_worker_output(data_dict['feats'], self.transport_dtype)
+        if data_dict['additional_feats'] is not None:
+            data_dict['additional_feats'] = to_worker_output(data_dict['additional_feats'], self.transport_dtype)
 
         return data_dict
@@ -97,7 +97,7 @@ class MultiTHUMOS14Dataset(Dataset):
                     label_dict[act['label']] = act['label_id']
 
         # fill in the db (immutable afterwards)
-        dict_db = tuple()
+        dict_db = []
         for key, value in json_db.items():
             # skip the video if not in the split
             if value['subset'].lower() not in self.split:
@@ -136,14 +136,14 @@ class MultiTHUMOS14Dataset(Dataset):
             else:
                 segments = None
                 labels = None
-            dict_db += ({'id': key,
-                         'fps': fps,
-                         'duration': duration,
-                         'segments': segments,
-                         'labels': labels
-                         },)
-
-        return dict_db, label_dict
+            dict_db.append({'id': key,
+                            'fps': fps,
+                            'duration': duration,
+                            'segments': segments,
+                            'labels': labels
+                            })
+
+        return tuple(dict_db), label_dict
 
     def __len__(self):
         return len(self.data_list)
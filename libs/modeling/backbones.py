@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from .blocks import (get_sinusoid_encoding, MaskedConv1D, ConvBlock, LayerNorm, SGPBlock, LocalMaskedMHCA)
+from .blocks import (get_sinusoid_encoding, maybe_compile, MaskedConv1D, ConvBlock, LayerNorm, SGPBlock,
+                     LocalMaskedMHCA)
 from .models import register_backbone
 
 
@@ -28,7 +29,8 @@ class SGPBackbone(nn.Module):
             k=1.5,  # the K in SGP
             init_conv_vars=1,  # initialization of gaussian variance for the weight in SGP
             use_abs_pe=False,  # use absolute position embedding
-            additional_fature=False
+            additional_fature=False,
+            use_compile=False,  # if to compile the forward pass with torch.compile
     ):
         super().__init__()
         assert len(arch) == 3
@@ -36,7 +38,7 @@ class SGPBackbone(nn.Module):
         self.arch = arch
         self.sgp_win_size = sgp_win_size
         self.max_len = max_len
-        self.relu = nn.ReLU(inplace=True)
+        self.with_ln = with_ln
         self.scale_factor = scale_factor
         self.use_abs_pe = use_abs_pe
         self.additional_fature = additional_fature
@@ -90,6 +92,9 @@ class SGPBackbone(nn.Module):
         # init weights
         self.apply(self.__init_weights__)
 
+        # the unbound forward is compiled, so that deepcopy / DataParallel replicas share it
+        self._forward_fn = maybe_compile(SGPBackbone._forward, use_compile)
+
     def __init_weights__(self, module):
         # set nn.Linear/nn.Conv1d bias term to 0
         if isinstance(module, (nn.Linear, nn.Conv1d)):
@@ -97,6 +102,9 @@ class SGPBackbone(nn.Module):
                 torch.nn.init.constant_(module.bias, 0.)
 
     def forward(self, x, mask, addtional_feature=None, additional_only=False):
+        return self._forward_fn(self, x, mask, addtional_feature, additional_only)
+
+    def _forward(self, x, mask, addtional_feature=None, additional_only=False):
         # x: batch size, feature channel, sequence length,
         # mask: batch size, 1, sequence length (bool)
         B, C, T = x.size()
@@ -105,7 +113,10 @@ class SGPBackbone(nn.Module):
             # embedding network
             for idx in range(len(self.embd)):
                 x, mask = self.embd[idx](x, mask)
-                x = self.relu(self.embd_norm[idx](x))
+                # no call into nn.Identity if there is no layernorm
+                if self.with_ln:
+                    x = self.embd_norm[idx](x)
+                x = F.relu_(x)
 
         # merge feature
         if addtional_feature is not None:
@@ -113,47 +124,44 @@ class SGPBackbone(nn.Module):
                 x = addtional_feature
 
         # training: using fixed length position embeddings
-        if self.use_abs_pe and self.training:
-            assert T <= self.max_len, "Reached max length."
-            pe = self.pos_embd
-            # add pe to x
-            x = x + pe[:, :, :T] * mask.to(x.dtype)
-
         # inference: re-interpolate position embeddings for over-length sequences
-        if self.use_abs_pe and (not self.training):
-            if T >= self.max_len:
+        if self.use_abs_pe:
+            if self.training:
+                assert T <= self.max_len, "Reached max length."
+            if T <= self.max_len:
+                pe = self.pos_embd
+            else:
                 pe = F.interpolate(
                     self.pos_embd, T, mode='linear', align_corners=False)
-            else:
-                pe = self.pos_embd
-            # add pe to x
+            # add pe to x (not in place, x may be the additional feature)
             x = x + pe[:, :, :T] * mask.to(x.dtype)
 
         # stem network
         for idx in range(len(self.stem)):
             x, mask = self.stem[idx](x, mask)
 
-        # prep for outputs
-        out_feats = tuple()
-        out_masks = tuple()
-        out_add_feats = tuple()
+        # prep for outputs (one slot per fpn level)
+        num_levels = 1 + len(self.branch)
+        out_feats = [None] * num_levels
+        out_masks = [None] * num_levels
+        out_add_feats = [None] * num_levels if addtional_feature is not None else []
         # 1x resolution
-        out_feats += (x,)
-        out_masks += (mask,)
+        out_feats[0] = x
+        out_masks[0] = mask
 
         if addtional_feature is not None:
-            out_add_feats += (addtional_feature,)
+            out_add_feats[0] = addtional_feature
 
         # main branch with downsampling
         for idx in range(len(self.branch)):
             x, mask = self.branch[idx](x, mask)
-            out_feats += (x,)
-            out_masks += (mask,)
+            out_feats[idx + 1] = x
+            out_masks[idx + 1] = mask
             if addtional_feature is not None:
                 addtional_feature, _ = self.additional_branch[idx](addtional_feature, mask)
-                out_add_feats += (addtional_feature,)
+                out_add_feats[idx + 1] = addtional_feature
 
-        return out_feats, out_masks, out_add_feats
+        return tuple(out_feats), tuple(out_masks), tuple(out_add_feats)
 
 
 @register_backbone("conv")
@@ -170,11 +178,12 @@ class ConvBackbone(nn.Module):
             arch=(2, 2, 5),  # (#convs, #stem convs, #branch convs)
             scale_factor=2,  # dowsampling rate for the branch
             with_ln=False,  # if to use layernorm
+            use_compile=False,  # if to compile the forward pass with torch.compile
     ):
         super().__init__()
         assert len(arch) == 3
         self.arch = arch
-        self.relu = nn.ReLU(inplace=True)
+        self.with_ln = with_ln
         self.scale_factor = scale_factor
 
         # embedding network using convs
@@ -210,6 +219,9 @@ class ConvBackbone(nn.Module):
         # init weights
         self.apply(self.__init_weights__)
 
+        # the unbound forward is compiled, so that deepcopy / DataParallel replicas share it
+        self._forward_fn = maybe_compile(ConvBackbone._forward, use_compile)
+
     def __init_weights__(self, module):
         # set nn.Linear bias term to 0
         if isinstance(module, (nn.Linear, nn.Conv1d)):
@@ -217,6 +229,9 @@ class ConvBackbone(nn.Module):
                 torch.nn.init.constant_(module.bias, 0.)
 
     def forward(self, x, mask):
+        return self._forward_fn(self, x, mask)
+
+    def _forward(self, x, mask):
         # x: batch size, feature channel, sequence length,
         # mask: batch size, 1, sequence length (bool)
         B, C, T = x.size()
@@ -224,23 +239,27 @@ class ConvBackbone(nn.Module):
         # embedding network
         for idx in range(len(self.embd)):
             x, mask = self.embd[idx](x, mask)
-            x = self.relu(self.embd_norm[idx](x))
+            # no call into nn.Identity if there is no layernorm
+            if self.with_ln:
+                x = self.embd_norm[idx](x)
+            x = F.relu_(x)
 
         # stem conv
         for idx in range(len(self.stem)):
             x, mask = self.stem[idx](x, mask)
 
-        # prep for outputs
-        out_feats = tuple()
-        out_masks = tuple()
+        # prep for outputs (one slot per fpn level)
+        num_levels = 1 + len(self.branch)
+        out_feats = [None] * num_levels
+        out_masks = [None] * num_levels
         # 1x resolution
-        out_feats += (x,)
-        out_masks += (mask,)
+        out_feats[0] = x
+        out_masks[0] = mask
 
         # main branch with downsampling
         for idx in range(len(self.branch)):
             x, mask = self.branch[idx](x, mask)
-            out_feats += (x,)
-            out_masks += (mask,)
+            out_feats[idx + 1] = x
+            out_masks[idx + 1] = mask
 
-        return out_feats, out_masks
+        return tuple(out_feats), tuple(out_masks)
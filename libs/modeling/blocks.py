@@ -61,6 +61,10 @@ class MaskedConv1D(nn.Module):
         out_mask = out_mask.bool()
         return out_conv, out_mask
 
+    def forward_nomask(self, x):
+        # same as forward for an all-valid mask (stride 1): the masking is a no-op
+        return self.conv(x)
+
 
 class LayerNorm(nn.Module):
     """
@@ -123,6 +127,14 @@ def get_sinusoid_encoding(n_position, d_hid):
     return torch.FloatTensor(sinusoid_table).unsqueeze(0).transpose(1, 2)
 
 
+def maybe_compile(fn, enable):
+    ''' Compile fn with torch.compile (if enabled and available) '''
+    if enable and hasattr(torch, 'compile'):
+        # specialize to the (padded) input shapes
+        return torch.compile(fn, dynamic=False)
+    return fn
+
+
 # attention / transformers
 class MaskedMHA(nn.Module):
     """
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -57,6 +59,9 @@ class PointGenerator(nn.Module):
 
         # generate all points and buffer the list
         self.buffer_points = self._generate_points()
+        # the points (views of the buffers) of the last few (fpn lengths, device, dtype), least recently used first
+        self._points_cache = OrderedDict()
+        self.points_cache_size = 8
 
     def _generate_points(self):
         points_list = []
@@ -80,10 +85,20 @@ class PointGenerator(nn.Module):
     def forward(self, feats):
         # feats will be a list of torch tensors
         assert len(feats) == self.fpn_levels
+        feat_lens = tuple(feat.shape[-1] for feat in feats)
+        buffer_pts0 = next(iter(self.buffer_points))
+        # the device / dtype of the buffers (e.g., after .to() / .half()), the views of old buffers are not reused
+        key = (feat_lens, buffer_pts0.device, buffer_pts0.dtype)
+        pts_list = self._points_cache.get(key)
+        if pts_list is not None:
+            self._points_cache.move_to_end(key)
+            return pts_list
         pts_list = []
-        feat_lens = [feat.shape[-1] for feat in feats]
         for feat_len, buffer_pts in zip(feat_lens, self.buffer_points):
             assert feat_len <= buffer_pts.shape[0], "Reached max buffer length for point generator"
             pts = buffer_pts[:feat_len, :]
             pts_list.append(pts)
+        self._points_cache[key] = pts_list
+        if len(self._points_cache) > self.points_cache_size:
+            self._points_cache.popitem(last=False)
         return pts_list
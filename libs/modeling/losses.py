@@ -9,6 +9,8 @@ def sigmoid_focal_loss(
         alpha: float = 0.25,
         gamma: float = 2.0,
         reduction: str = "none",
+        ls_scale: float = 1.0,
+        ls_bias: float = 0.0,
 ) -> torch.Tensor:
     """
     Loss used in RetinaNet for dense detection: https://arxiv.org/abs/1708.02002.
@@ -30,11 +32,15 @@ def sigmoid_focal_loss(
                  'none': No reduction will be applied to the output.
                  'mean': The output will be averaged.
                  'sum': The output will be summed.
+        ls_scale / ls_bias: (optional) label smoothing folded into the loss,
+                 the targets are ls_scale * targets + ls_bias.
     Returns:
         Loss tensor with the reduction option applied.
     """
     inputs = inputs.float()
     targets = targets.float()
+    if ls_scale != 1.0 or ls_bias != 0.0:
+        targets = targets * ls_scale + ls_bias
     p = torch.sigmoid(inputs)
     ce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
     p_t = p * targets + (1 - p) * (1 - targets)
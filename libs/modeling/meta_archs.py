@@ -1,15 +1,66 @@
 import math
+from collections import OrderedDict
+from typing import Optional, Tuple
+
 import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.nn.utils.rnn import pad_sequence
 
-from .blocks import MaskedConv1D, Scale, LayerNorm
+from .blocks import maybe_compile, MaskedConv1D, Scale, LayerNorm
 from .losses import ctr_diou_loss_1d, sigmoid_focal_loss, ctr_giou_loss_1d
 from .models import register_meta_arch, make_backbone, make_neck, make_generator
 from ..utils import batched_nms
 
 
+def pack_fpn_levels(fpn_feats, fpn_masks, guard):
+    """
+    Concat all pyramid levels along time (B x C x sum(T_i) + guards), with `guard` zero columns
+    between two levels so that a conv with kernel size <= 2 * guard + 1 does not mix the levels.
+    Return the packed feats / masks, a 1 x 1 x L keep mask (zero at the guards) and the level sizes
+    """
+    sizes = [x.shape[-1] for x in fpn_feats]
+    feats, masks, keep = [], [], []
+    for l, (feat, mask) in enumerate(zip(fpn_feats, fpn_masks)):
+        if l > 0 and guard > 0:
+            feats.append(feat.new_zeros((feat.shape[0], feat.shape[1], guard)))
+            masks.append(mask.new_zeros((mask.shape[0], mask.shape[1], guard)))
+            keep.append(feat.new_zeros((guard,)))
+        feats.append(feat)
+        masks.append(mask)
+        keep.append(feat.new_ones((feat.shape[-1],)))
+    return torch.cat(feats, dim=2), torch.cat(masks, dim=2), torch.cat(keep)[None, None], sizes
+
+
+def packed_all_valid(mask, keep):
+    """
+    Check if all positions of the packed levels are valid (no padding, the guards excluded).
+    Then masking the intermediate outputs of a head is a no-op, as the guards are zeroed by keep
+    """
+    return bool(torch.all(mask | (keep == 0)))
+
+
+def unpack_fpn_levels(x, sizes, guard):
+    """
+    Split a packed B x C x L tensor back into the pyramid levels (dropping the guards)
+    """
+    if guard == 0:
+        return torch.split(x, sizes, dim=2)
+    split_sizes = [sizes[0]]
+    for size in sizes[1:]:
+        split_sizes += [guard, size]
+    return torch.split(x, split_sizes, dim=2)[::2]
+
+
+def strip_fpn_guards(x, sizes, guard):
+    """
+    Drop the guards of a packed B x C x L tensor in one gather, i.e. the levels concatenated along time (B x C x FT)
+    """
+    if guard == 0:
+        return x
+    return torch.cat(unpack_fpn_levels(x, sizes, guard), dim=2)
+
+
 class ClsHead(nn.Module):
     """
     1D Conv heads for classification
@@ -26,11 +77,14 @@ class ClsHead(nn.Module):
             act_layer=nn.ReLU,
             with_ln=False,
             empty_cls=[],
-            detach_feat=False
+            detach_feat=False,
+            use_compile=False  # if to compile the forward pass with torch.compile
     ):
         super().__init__()
         self.act = act_layer()
         self.detach_feat = detach_feat
+        # zero columns between the packed pyramid levels
+        self.guard = kernel_size // 2
 
         # build the head
         self.head = nn.ModuleList()
@@ -76,26 +130,110 @@ class ClsHead(nn.Module):
             for idx in empty_cls:
                 torch.nn.init.constant_(self.cls_head.conv.bias[idx], bias_value)
 
+        # the unbound forward is compiled, so that deepcopy / DataParallel replicas share it
+        self._forward_fn = maybe_compile(ClsHead._forward, use_compile)
+
     def forward(self, fpn_feats, fpn_masks):
+        return self._forward_fn(self, fpn_feats, fpn_masks)
+
+    def _forward(self, fpn_feats, fpn_masks):
         assert len(fpn_feats) == len(fpn_masks)
 
-        # apply the classifier for each pyramid level
-        out_logits = tuple()
-        for _, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)):
-            if self.detach_feat:
-                cur_out = cur_feat.detach()
+        # apply the classifier to all pyramid levels at once (packed along time)
+        cur_out, cur_mask, keep, sizes = pack_fpn_levels(fpn_feats, fpn_masks, self.guard)
+        if self.detach_feat:
+            cur_out = cur_out.detach()
+        # only mask the last output if there is no padding
+        all_valid = packed_all_valid(cur_mask, keep)
+        for idx in range(len(self.head)):
+            if all_valid:
+                cur_out = self.head[idx].forward_nomask(cur_out)
             else:
-                cur_out = cur_feat
-            for idx in range(len(self.head)):
                 cur_out, _ = self.head[idx](cur_out, cur_mask)
-                cur_out = self.act(self.norm[idx](cur_out))
-            cur_logits, _ = self.cls_head(cur_out, cur_mask)
-            out_logits += (cur_logits,)
+            # norm / act (e.g., the bias of layernorm) refill the guards, zero them again
+            cur_out = self.act(self.norm[idx](cur_out)) * keep
+        cur_logits, _ = self.cls_head(cur_out, cur_mask)
+        # B x #cls x FT (all levels concatenated)
+        out_logits = strip_fpn_guards(cur_logits, sizes, self.guard)
 
         # fpn_masks remains the same
         return out_logits
 
 
+def _grouped_layer_norm(x, groups, eps, weight, bias):
+    # apply the layernorms of several heads to their groups of channels (B, G x C, T)
+    # weight / bias: the concatenated affine params of the heads (1, G x C, 1), or None
+    B, _, T = x.shape
+    x = x.view(B, groups, -1, T)
+    mu = torch.mean(x, dim=2, keepdim=True)
+    res_x = x - mu
+    sigma = torch.mean(res_x ** 2, dim=2, keepdim=True)
+    out = (res_x / torch.sqrt(sigma + eps)).view(B, -1, T)
+    if weight is not None:
+        out = out * weight + bias
+    return out
+
+
+def cat_head_params(heads):
+    """
+    Concat the params of several ClsHead of the same config, for fused_cls_heads.
+    Return a list with one tuple per layer (the classifier last):
+    (conv weight, conv bias or None, norm weight or None, norm bias or None)
+    """
+    head0 = heads[0]
+    params = []
+    for idx in range(len(head0.head)):
+        conv_bias = head0.head[idx].conv.bias is not None
+        affine = isinstance(head0.norm[idx], LayerNorm) and head0.norm[idx].affine
+        params.append((
+            torch.cat([h.head[idx].conv.weight for h in heads]),
+            torch.cat([h.head[idx].conv.bias for h in heads]) if conv_bias else None,
+            torch.cat([h.norm[idx].weight for h in heads], dim=1) if affine else None,
+            torch.cat([h.norm[idx].bias for h in heads], dim=1) if affine else None,
+        ))
+    params.append((
+        torch.cat([h.cls_head.conv.weight for h in heads]),
+        torch.cat([h.cls_head.conv.bias for h in heads]),
+        None, None
+    ))
+    return params
+
+
+def fused_cls_heads(heads, params, fpn_feats, fpn_masks):
+    """
+    Run several ClsHead of the same config on the same inputs as a single head:
+    the first conv uses the concatenated weights of all heads, later convs are grouped (one group per head).
+    params: the concatenated params of the heads (see cat_head_params), so the params / checkpoints
+    of each head are unchanged.
+    Return the (per-level) outputs of all heads, concatenated along the channels in the order of the heads
+    """
+    head0, num_heads = heads[0], len(heads)
+    cur_out, cur_mask, keep, sizes = pack_fpn_levels(fpn_feats, fpn_masks, head0.guard)
+    if head0.detach_feat:
+        cur_out = cur_out.detach()
+    out_mask = cur_mask.to(cur_out.dtype)
+
+    # only mask the last output if there is no padding
+    all_valid = packed_all_valid(cur_mask, keep)
+
+    def masked_conv(x, conv, weight, bias, groups, use_mask=True):
+        x = F.conv1d(x, weight, bias, padding=conv.conv.padding, groups=groups)
+        return x * out_mask if use_mask else x
+
+    for idx in range(len(head0.head)):
+        weight, bias, norm_weight, norm_bias = params[idx]
+        cur_out = masked_conv(cur_out, head0.head[idx], weight, bias, 1 if idx == 0 else num_heads,
+                              use_mask=not all_valid)
+        if isinstance(head0.norm[idx], LayerNorm):
+            cur_out = _grouped_layer_norm(cur_out, num_heads, head0.norm[idx].eps, norm_weight, norm_bias)
+        # norm / act refill the guards, zero them again
+        cur_out = head0.act(cur_out) * keep
+    weight, bias, _, _ = params[-1]
+    cur_logits = masked_conv(cur_out, head0.cls_head, weight, bias, 1 if len(head0.head) == 0 else num_heads)
+
+    return unpack_fpn_levels(cur_logits, sizes, head0.guard)
+
+
 class RegHead(nn.Module):
     """
     Shared 1D Conv heads for regression
@@ -111,11 +249,14 @@ class RegHead(nn.Module):
             kernel_size=3,
             act_layer=nn.ReLU,
             with_ln=False,
-            num_bins=16
+            num_bins=16,
+            use_compile=False  # if to compile the forward pass with torch.compile
     ):
         super().__init__()
         self.fpn_levels = fpn_levels
         self.act = act_layer()
+        # zero columns between the packed pyramid levels
+        self.guard = kernel_size // 2
 
         # build the conv head
         self.head = nn.ModuleList()
@@ -151,24 +292,179 @@ class RegHead(nn.Module):
             stride=1, padding=kernel_size // 2
         )
 
+        # the unbound forward is compiled, so that deepcopy / DataParallel replicas share it
+        self._forward_fn = maybe_compile(RegHead._forward, use_compile)
+
     def forward(self, fpn_feats, fpn_masks):
+        return self._forward_fn(self, fpn_feats, fpn_masks)
+
+    def _forward(self, fpn_feats, fpn_masks):
         assert len(fpn_feats) == len(fpn_masks)
         assert len(fpn_feats) == self.fpn_levels
 
-        # apply the classifier for each pyramid level
-        out_offsets = tuple()
-        for l, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)):
-            cur_out = cur_feat
-            for idx in range(len(self.head)):
+        # apply the regressor to all pyramid levels at once (packed along time)
+        cur_out, cur_mask, keep, sizes = pack_fpn_levels(fpn_feats, fpn_masks, self.guard)
+        # only mask the last output if there is no padding
+        all_valid = packed_all_valid(cur_mask, keep)
+        for idx in range(len(self.head)):
+            if all_valid:
+                cur_out = self.head[idx].forward_nomask(cur_out)
+            else:
                 cur_out, _ = self.head[idx](cur_out, cur_mask)
-                cur_out = self.act(self.norm[idx](cur_out))
-            cur_offsets, _ = self.offset_head(cur_out, cur_mask)
-            out_offsets += (F.relu(self.scale[l](cur_offsets)),)
+            # norm / act (e.g., the bias of layernorm) refill the guards, zero them again
+            cur_out = self.act(self.norm[idx](cur_out)) * keep
+        cur_offsets, _ = self.offset_head(cur_out, cur_mask)
+        # per-level scales as a single 1 x 1 x L vector (a guard takes the scale of the next level)
+        scales = torch.cat([
+            self.scale[l].scale.expand(size + (self.guard if l > 0 else 0)) for l, size in enumerate(sizes)
+        ])
+        # B x 2 (num_bins + 1) x FT (all levels concatenated)
+        out_offsets = strip_fpn_guards(F.relu(cur_offsets * scales), sizes, self.guard)
 
         # fpn_masks remains the same
         return out_offsets
 
 
+def assign_points_to_segments(
+        pts: torch.Tensor,
+        reg_lo: torch.Tensor,
+        reg_hi: torch.Tensor,
+        stride: torch.Tensor,
+        gt_segments: torch.Tensor,
+        gt_valid: torch.Tensor,
+        center_sample: bool,
+        center_sample_radius: float
+):
+    """
+    Compute the regression targets of all points w.r.t. all segments of a batch (B x F T x N x 2),
+    and the segment lengths (B x F T x N) set to inf where a point can not be assigned to a segment.
+    All B x F T x N terms are computed by broadcasting, without expanding the points / segments
+    """
+    # pts / reg_lo / reg_hi / stride : F T x 1 (the columns of the concatenated points)
+    # gt_segments : B x N (#Events, padded) x 2, gt_valid : B x N (False for the padding)
+    gt_left, gt_right = gt_segments[:, None, :, 0], gt_segments[:, None, :, 1]
+
+    # compute the distance of every point to each segment boundary -> B x F T x N
+    left = pts - gt_left
+    right = gt_right - pts
+
+    if center_sample:
+        # center of all segments B x 1 x N
+        center_pts = 0.5 * (gt_left + gt_right)
+        # center sampling based on stride radius
+        t_mins = center_pts - stride * center_sample_radius
+        t_maxs = center_pts + stride * center_sample_radius
+        # prevent t_mins / maxs from over-running the action boundary
+        # B x F T x N (distance to the new boundary)
+        cb_dist_left = pts - torch.maximum(t_mins, gt_left)
+        cb_dist_right = torch.minimum(t_maxs, gt_right) - pts
+        inside_gt_seg_mask = torch.minimum(cb_dist_left, cb_dist_right) > 0
+    else:
+        # inside an gt action
+        inside_gt_seg_mask = torch.minimum(left, right) > 0
+
+    # limit the regression range for each location
+    max_regress_distance = torch.maximum(left, right)
+    valid = inside_gt_seg_mask & (max_regress_distance >= reg_lo) \
+            & (max_regress_distance <= reg_hi) & gt_valid[:, None, :]
+
+    # lengths of the segments, inf for the points out of a segment / regression range (or padded)
+    lens = (gt_right - gt_left).expand_as(valid)
+    lens = lens.masked_fill(torch.logical_not(valid), float('inf'))
+
+    # auto broadcasting for all reg target-> B x F T x N x2
+    reg_targets = torch.stack((left, right), dim=-1)
+    return reg_targets, lens
+
+
+def unfold_bins_levels(xs, num_bins):
+    """
+    Sliding windows of num_bins + 1 steps along time (the last dim) of all pyramid levels (F list [..., 2C, T_i]),
+    for the start logits (first C channels, windows ending at t) and the end logits (last C channels, windows
+    starting at t) at once. All levels are unfolded in one go: they are concatenated with num_bins zeros before,
+    between and after them, and the windows overlapping two levels are dropped.
+    Return the start and the end windows, ... x C x FT x (num_bins + 1) each
+    """
+    # one (shared) gap of zeros, and one cat that writes all levels and gaps: there is no per-level pad,
+    # and the buffer is not cached across calls as cat(out=...) does not support autograd
+    zeros = xs[0].new_zeros(xs[0].shape[:-1] + (num_bins,))
+    parts = [zeros]
+    for x in xs:
+        parts += [x, zeros]
+    windows = torch.cat(parts, dim=-1).unfold(-1, num_bins + 1, 1)
+    start_windows, end_windows = windows.chunk(2, dim=-3)
+    # a window ending at t starts num_bins steps before the window starting at t,
+    # and the windows of each level are separated by num_bins windows over the zeros
+    split_sizes = []
+    for x in xs:
+        split_sizes += [x.shape[-1], num_bins]
+    split_sizes = split_sizes[:-1]
+    start_windows = torch.split(start_windows[..., :-num_bins, :], split_sizes, dim=-2)[::2]
+    end_windows = torch.split(end_windows[..., num_bins:, :], split_sizes, dim=-2)[::2]
+    return torch.cat(start_windows, dim=-2), torch.cat(end_windows, dim=-2)
+
+
+def _decode_expectation(pred_left_dis: torch.Tensor, pred_right_dis: torch.Tensor,
+                        left_range_idx: torch.Tensor, right_range_idx: torch.Tensor):
+    # calculate the value of expectation for the offset from the bin distributions
+    # range_idx: (num_bins + 1), the bin indices (reversed for the left side)
+
+    # each side masks its own NaNs, in-place unless autograd needs the softmax outputs (for backward)
+    if pred_left_dis.requires_grad or pred_right_dis.requires_grad:
+        pred_left_dis = torch.nan_to_num(pred_left_dis, nan=0.0)
+        pred_right_dis = torch.nan_to_num(pred_right_dis, nan=0.0)
+    else:
+        pred_left_dis.nan_to_num_(nan=0.0)
+        pred_right_dis.nan_to_num_(nan=0.0)
+
+    # expectation as a pointwise mul + reduction (fuses with the softmax when compiled)
+    decoded_offset_left = (pred_left_dis * left_range_idx).sum(-1, keepdim=True)
+    decoded_offset_right = (pred_right_dis * right_range_idx).sum(-1, keepdim=True)
+    return torch.cat([decoded_offset_left, decoded_offset_right], dim=-1)
+
+
+def _decode_offset(out_offsets: torch.Tensor, pred_left: Optional[torch.Tensor], pred_right: Optional[torch.Tensor],
+                   left_range_idx: torch.Tensor, right_range_idx: torch.Tensor, num_classes: int, multi_label: bool):
+    """
+    Decode the offsets for training (all FPN levels concatenated, B x F T x ...) and for inference (F T x ...)
+    out_offsets: ... x 2 (num_bins + 1) (x C if multi_label)
+    pred_left / right: ... x C x (num_bins + 1), the boundary windows of the Trident-head (None without it)
+    Return ... (x C) x 2
+    """
+    if pred_left is None or pred_right is None:
+        if multi_label:
+            out_offsets = out_offsets.unflatten(-1, [num_classes, -1])
+        return out_offsets
+
+    if multi_label:
+        # ... x 2 x C x (num_bins + 1)
+        out_offsets = out_offsets.unflatten(-1, [2, num_classes, -1])
+    else:
+        # ... x 2 x 1 x (num_bins + 1), shared by all classes
+        out_offsets = out_offsets.unflatten(-1, [2, 1, -1])
+    pred_left_dis = torch.softmax(pred_left + out_offsets.select(-3, 0), dim=-1)
+    pred_right_dis = torch.softmax(pred_right + out_offsets.select(-3, 1), dim=-1)
+    return _decode_expectation(pred_left_dis, pred_right_dis, left_range_idx, right_range_idx)
+
+
+def _pos_mask_multi(gt_cls: torch.Tensor, valid_mask: torch.Tensor) -> torch.Tensor:
+    # positive (point, class) pairs: B x FT x C
+    return (gt_cls > 0) & valid_mask.unsqueeze(-1)
+
+
+def _pos_mask_single(gt_cls: torch.Tensor, valid_mask: torch.Tensor) -> torch.Tensor:
+    # positive points: B x FT
+    return (gt_cls.sum(-1) > 0) & valid_mask
+
+
+def _decode_segs(pts: torch.Tensor, stride: torch.Tensor, offsets: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # pts / stride: N, offsets: N x 2 (normalized by stride)
+    # return the segments N x 2 and their durations N (in feature grids)
+    seg_left = pts - offsets[:, 0] * stride
+    seg_right = pts + offsets[:, 1] * stride
+    return torch.stack((seg_left, seg_right), -1), seg_right - seg_left
+
+
 @register_meta_arch("TriDet")
 class TriDet(nn.Module):
     """
@@ -211,7 +507,8 @@ class TriDet(nn.Module):
             multi_label,
             additional_fature=False,
             additional_dim=-1,
-            additional_only=False
+            additional_only=False,
+            use_compile=False  # if to compile the backbone / heads / offset decoding with torch.compile
     ):
         super().__init__()
         # re-distribute params to backbone / neck / head
@@ -251,6 +548,10 @@ class TriDet(nn.Module):
         self.train_dropout = train_cfg['dropout']
         self.train_droppath = train_cfg['droppath']
         self.train_label_smoothing = train_cfg['label_smoothing']
+        # label smoothing as an affine map of the targets (applied within the focal loss)
+        self.train_ls_scale = 1 - self.train_label_smoothing
+        self.train_ls_bias = self.train_label_smoothing / (self.num_classes + 1)
+        self.train_pad_to_max_seq_len = train_cfg['pad_to_max_seq_len']
 
         # test time config
         self.test_pre_nms_thresh = test_cfg['pre_nms_thresh']
@@ -264,7 +565,26 @@ class TriDet(nn.Module):
         self.test_multiclass_nms = test_cfg['multiclass_nms']
         self.test_nms_sigma = test_cfg['nms_sigma']
         self.test_voting_thresh = test_cfg['voting_thresh']
+        # if to run the heads under autocast (reduced precision) at inference
+        self.test_head_autocast = test_cfg['head_autocast']
+        # optional padding of long inputs to a few fixed lengths: max_seq_len x 2^k (within the point buffer)
+        self.test_len_buckets = []
+        if test_cfg['pad_to_buckets']:
+            bucket = 2 * max_seq_len
+            while bucket <= max_seq_len * max_buffer_len_factor:
+                self.test_len_buckets.append(bucket)
+                bucket *= 2
         self.num_bins = num_bins
+        # concatenated points of the last few fpn lengths (see concat_point_columns)
+        self._concat_points_cache = OrderedDict()
+        self.concat_points_cache_size = 8
+        # concatenated params of the boundary heads at inference (see boundary_head_params)
+        self._boundary_params_cache = None
+        # bin indices used to decode the offsets (fixed by num_bins, not saved in checkpoints)
+        self.register_buffer("left_range_idx",
+                             torch.arange(num_bins, -1, -1, dtype=torch.float), persistent=False)
+        self.register_buffer("right_range_idx",
+                             torch.arange(num_bins + 1, dtype=torch.float), persistent=False)
         self.use_trident_head = use_trident_head
         self.additional_fature = additional_fature
         self.additional_only = additional_only
@@ -290,7 +610,8 @@ class TriDet(nn.Module):
                     'use_abs_pe': use_abs_pe,
                     'k': k,
                     'init_conv_vars': init_conv_vars,
-                    'additional_fature': self.additional_fature
+                    'additional_fature': self.additional_fature,
+                    'use_compile': use_compile
                 }
             )
         else:
@@ -303,6 +624,7 @@ class TriDet(nn.Module):
                     'arch': backbone_arch,
                     'scale_factor': scale_factor,
                     'with_ln': embd_with_ln,
+                    'use_compile': use_compile,
                 }
             )
 
@@ -337,7 +659,8 @@ class TriDet(nn.Module):
             prior_prob=self.train_cls_prior_prob,
             with_ln=head_with_ln,
             num_layers=head_num_layers,
-            empty_cls=train_cfg['head_empty_cls']
+            empty_cls=train_cfg['head_empty_cls'],
+            use_compile=use_compile
         )
 
         if use_trident_head:
@@ -353,7 +676,8 @@ class TriDet(nn.Module):
                 with_ln=head_with_ln,
                 num_layers=head_num_layers,
                 empty_cls=train_cfg['head_empty_cls'],
-                detach_feat=True
+                detach_feat=True,
+                use_compile=use_compile
             )
             self.end_head = ClsHead(
                 fpn_dim, head_dim, self.num_classes,
@@ -362,7 +686,8 @@ class TriDet(nn.Module):
                 with_ln=head_with_ln,
                 num_layers=head_num_layers,
                 empty_cls=train_cfg['head_empty_cls'],
-                detach_feat=True
+                detach_feat=True,
+                use_compile=use_compile
             )
 
             self.reg_head = RegHead(
@@ -370,7 +695,8 @@ class TriDet(nn.Module):
                 kernel_size=head_kernel_size,
                 num_layers=head_num_layers,
                 with_ln=head_with_ln,
-                num_bins=model_bins
+                num_bins=model_bins,
+                use_compile=use_compile
             )
         else:
             if self.multi_label:
@@ -382,9 +708,14 @@ class TriDet(nn.Module):
                 kernel_size=head_kernel_size,
                 num_layers=head_num_layers,
                 with_ln=head_with_ln,
-                num_bins=model_bins
+                num_bins=model_bins,
+                use_compile=use_compile
             )
 
+        # the fused boundary heads and the offset decoding (unbound, shared by deepcopy / replicas)
+        self._fused_cls_heads_fn = maybe_compile(fused_cls_heads, use_compile)
+        self._decode_offset_fn = maybe_compile(_decode_offset, use_compile)
+
         if self.additional_fature:
             self.pose_conv = False
             if self.pose_conv:
@@ -426,75 +757,54 @@ class TriDet(nn.Module):
                 )
 
             else:
+                # in-place relus (the groupnorms keep their inputs, not their outputs, for backward)
                 self.additional_embed = nn.Sequential(
                     nn.Conv1d(additional_dim, embd_dim, kernel_size=1),
                     nn.GroupNorm(16, embd_dim),
-                    nn.ReLU(),
+                    nn.ReLU(inplace=True),
                     nn.Conv1d(embd_dim, embd_dim, kernel_size=1),
                     nn.GroupNorm(16, embd_dim),
-                    nn.ReLU()
+                    nn.ReLU(inplace=True)
                 )
 
 
         # maintain an EMA of #foreground to stabilize the loss normalizer
         # useful for small mini-batch training
-        self.loss_normalizer = train_cfg['init_loss_norm']
+        # kept on device (updated without syncing the host), not saved in checkpoints
+        self.register_buffer("loss_normalizer",
+                             torch.tensor(float(train_cfg['init_loss_norm'])), persistent=False)
         self.loss_normalizer_momentum = 0.9
 
     @property
     def device(self):
-        # a hacky way to get the device type
-        # will throw an error if parameters are on different devices
-        return list(set(p.device for p in self.parameters()))[0]
+        # the device of the model, read from a buffer (moves with the parameters) instead of
+        # scanning all parameters; unlike a cached value, it is also right for DataParallel replicas
+        return self.left_range_idx.device
+
+    def train(self, mode=True):
+        # drop the cached params of the boundary heads when switching between training / inference
+        self._boundary_params_cache = None
+        return super().train(mode)
+
+    def boundary_head_params(self):
+        # the concatenated params of the start / end heads (for the fused heads)
+        heads = (self.start_head, self.end_head)
+        if torch.is_grad_enabled():
+            # the cat is redone at every step, so that autograd sends the gradients back to the params of each head
+            return cat_head_params(heads)
+        # without autograd (inference), the cat is cached until a param is replaced or updated in place
+        # (e.g., optimizer steps, ModelEma updates or load_state_dict, which bump its version)
+        key = tuple((p.data_ptr(), p._version) for h in heads for p in h.parameters())
+        if self._boundary_params_cache is None or self._boundary_params_cache[0] != key:
+            self._boundary_params_cache = (key, cat_head_params(heads))
+        return self._boundary_params_cache[1]
 
     def decode_offset(self, out_offsets, pred_left, pred_right):
-        if not self.use_trident_head:
-            if self.training:
-                out_offsets = torch.cat(out_offsets, dim=1)
-            if self.multi_label:
-                out_offsets = out_offsets.reshape(out_offsets.shape[:-1] + (self.num_classes, -1))
-            return out_offsets
-
-        else:
-            # Make an adaption for train and validation, when training, the out_offsets is a list with feature outputs
-            # from each FPN level. Each feature with shape [batchsize, T_level, (Num_bin+1)x2].
-            # For validation, the out_offsets is a feature with shape [T_level, (Num_bin+1)x2]
-            if self.training:
-                pred_left = torch.cat(pred_left, dim=1)
-                pred_right = torch.cat(pred_right, dim=1)
-                if self.multi_label:
-                    out_offsets = torch.cat(out_offsets, dim=1)
-                    out_offsets = out_offsets.view(out_offsets.shape[:2] + (2, self.num_classes, -1))
-                    pred_left_dis = torch.softmax(pred_left + out_offsets[:, :, 0, :], dim=-1)
-                    pred_right_dis = torch.softmax(pred_right + out_offsets[:, :, 1, :], dim=-1)
-                else:
-                    out_offsets = torch.cat(out_offsets, dim=1)
-                    out_offsets = out_offsets.view(out_offsets.shape[:2] + (2, -1))
-                    pred_left_dis = torch.softmax(pred_left + out_offsets[:, :, :1, :], dim=-1)
-                    pred_right_dis = torch.softmax(pred_right + out_offsets[:, :, 1:, :], dim=-1)
-            else:
-                if self.multi_label:
-                    out_offsets = out_offsets.view(out_offsets.shape[0], 2, self.num_classes, -1)
-                    pred_left_dis = torch.softmax(pred_left + out_offsets[:, 0, :], dim=-1)
-                    pred_right_dis = torch.softmax(pred_right + out_offsets[:, 1, :], dim=-1)
-                else:
-                    out_offsets = out_offsets.view(out_offsets.shape[0], 2, -1)
-                    pred_left_dis = torch.softmax(pred_left + out_offsets[None, :, 0, :], dim=-1)
-                    pred_right_dis = torch.softmax(pred_right + out_offsets[None, :, 1, :], dim=-1)
-
-            max_range_num = pred_left_dis.shape[-1]
-
-            left_range_idx = torch.arange(max_range_num - 1, -1, -1, device=pred_left.device,
-                                          dtype=torch.float).unsqueeze(-1)
-            right_range_idx = torch.arange(max_range_num, device=pred_right.device, dtype=torch.float).unsqueeze(-1)
-
-            pred_left_dis = pred_left_dis.masked_fill(torch.isnan(pred_right_dis), 0)
-            pred_right_dis = pred_right_dis.masked_fill(torch.isnan(pred_right_dis), 0)
-
-            # calculate the value of expectation for the offset:
-            decoded_offset_left = torch.matmul(pred_left_dis, left_range_idx)
-            decoded_offset_right = torch.matmul(pred_right_dis, right_range_idx)
-            return torch.cat([decoded_offset_left, decoded_offset_right], dim=-1)
+        # the out_offsets are the concatenated outputs of all FPN levels, with shape [batchsize, FT, (Num_bin+1)x2]
+        # for training, and [FT, (Num_bin+1)x2] for validation; pred_left / right: ... x cls_num x (Num_bin+1)
+        return self._decode_offset_fn(out_offsets, pred_left, pred_right,
+                                      self.left_range_idx, self.right_range_idx,
+                                      self.num_classes, self.multi_label)
 
     def forward(self, video_list):
         # drop the data without annotation first
@@ -521,49 +831,60 @@ class TriDet(nn.Module):
         # (shared across all samples in the mini-batch)
         points = self.point_generator(fpn_feats)
 
-        # out_cls: List[B, #cls + 1, T_i]
-        out_cls_logits = self.cls_head(fpn_feats, fpn_masks)
+        # optionally run the heads in reduced precision at inference (fp16 on GPUs, bf16 on CPUs)
+        head_autocast = self.test_head_autocast and not self.training
+        device_type = fpn_feats[0].device.type
+        with torch.autocast(device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16,
+                            enabled=head_autocast):
+            # out_cls: [B, #cls, FT] (all levels concatenated)
+            out_cls_logits = self.cls_head(fpn_feats, fpn_masks)
 
-        if self.additional_fature and not self.additional_only:
-            fpn_feats = [feat + add_feat for feat, add_feat in zip(fpn_feats, batched_add_feats)]
+            if self.additional_fature and not self.additional_only:
+                fpn_feats = [feat + add_feat for feat, add_feat in zip(fpn_feats, batched_add_feats)]
 
-        if self.use_trident_head:
-            out_lb_logits = self.start_head(fpn_feats, fpn_masks)
-            out_rb_logits = self.end_head(fpn_feats, fpn_masks)
-        else:
-            out_lb_logits = None
-            out_rb_logits = None
+            if self.use_trident_head:
+                # start / end heads share the input, run them as one grouped head
+                # out_bd_logits: F List[B, 2 x #cls (start | end), T_i], per-level views (no copy) for the unfold
+                out_bd_logits = self._fused_cls_heads_fn(
+                    (self.start_head, self.end_head), self.boundary_head_params(), fpn_feats, fpn_masks)
+            else:
+                out_bd_logits = None
+
+            # out_offset: [B, 2 (xC), FT] (all levels concatenated)
+            out_offsets = self.reg_head(fpn_feats, fpn_masks)
 
-        # out_offset: List[B, 2, T_i]
-        out_offsets = self.reg_head(fpn_feats, fpn_masks)
+        if head_autocast:
+            # decode the outputs in fp32
+            out_cls_logits = out_cls_logits.float()
+            out_offsets = out_offsets.float()
+            if self.use_trident_head:
+                out_bd_logits = [x.float() for x in out_bd_logits]
 
-        # permute the outputs
-        # out_cls: F List[B, #cls, T_i] -> F List[B, T_i, #cls]
-        out_cls_logits = [x.permute(0, 2, 1) for x in out_cls_logits]
-        # out_offset: F List[B, 2 (xC), T_i] -> F List[B, T_i, 2 (xC)]
-        out_offsets = [x.permute(0, 2, 1) for x in out_offsets]
-        # fpn_masks: F list[B, 1, T_i] -> F List[B, T_i]
-        fpn_masks = [x.squeeze(1) for x in fpn_masks]
+        # out_cls: [B, #cls, FT] -> [B, FT, #cls]
+        out_cls_logits = out_cls_logits.permute(0, 2, 1)
+        # out_offset: [B, 2 (xC), FT] -> [B, FT, 2 (xC)]
+        out_offsets = out_offsets.permute(0, 2, 1)
+        # fpn_masks: F list[B, 1, T_i] -> [B, FT]
+        fpn_masks = torch.cat(fpn_masks, dim=2).squeeze(1)
 
         # return loss during training
         if self.training:
             # generate segment/lable List[N x 2] / List[N] with length = B
             assert video_list[0]['segments'] is not None, "GT action labels does not exist"
             assert video_list[0]['labels'] is not None, "GT action labels does not exist"
-            gt_segments = [x['segments'].to(self.device) for x in video_list]
-            gt_labels = [x['labels'].to(self.device) for x in video_list]
+            gt_segments, gt_labels, num_gts = self.preprocessing_gt(video_list)
 
             # compute the gt labels for cls & reg
             # list of prediction targets
             gt_cls_labels, gt_offsets = self.label_points(
-                points, gt_segments, gt_labels)
+                points, gt_segments, gt_labels, num_gts)
 
             # compute the loss and return
             losses = self.losses(
                 fpn_masks,
                 out_cls_logits, out_offsets,
                 gt_cls_labels, gt_offsets,
-                out_lb_logits, out_rb_logits,
+                out_bd_logits,
             )
             return losses
 
@@ -572,16 +893,41 @@ class TriDet(nn.Module):
             results = self.inference(
                 video_list, points, fpn_masks,
                 out_cls_logits, out_offsets,
-                out_lb_logits, out_rb_logits,
+                out_bd_logits,
             )
             return results
 
+    @torch.no_grad()
+    def preprocessing_gt(self, video_list):
+        """
+            Pad the GT segments / labels of a batch to B x N_max (x 2) and move them to the device at once.
+            Return the padded segments and labels, and the number of GT actions of each video
+        """
+        num_gts = [x['segments'].shape[0] for x in video_list]
+        # pack the labels as a third column (class ids are exact in float), a single copy for both
+        gts = pad_sequence(
+            [torch.cat((x['segments'].float(), x['labels'][:, None].float()), dim=1) for x in video_list],
+            batch_first=True
+        )
+        device = self.device
+        if gts.device != device:
+            if device.type == 'cuda':
+                gts = gts.pin_memory()
+            gts = gts.to(device, non_blocking=True)
+        return gts[..., :2], gts[..., 2].long(), num_gts
+
     @torch.no_grad()
     def preprocessing(self, video_list, padding_val=0.0):
         """
             Generate batched features and masks from a list of dict items
         """
-        feats = [x['feats'] for x in video_list]
+        # resize the feats on device if the dataset deferred it (e.g., force_upsampling)
+        feats = [
+            F.interpolate(
+                x['feats'][None].float(), size=x['target_len'], mode='linear', align_corners=False
+            )[0] if x.get('target_len') is not None else x['feats']
+            for x in video_list
+        ]
         feats_lens = torch.as_tensor([feat.shape[-1] for feat in feats], device=feats[0].device)
         max_len = feats_lens.max(0).values.item()
 
@@ -593,23 +939,25 @@ class TriDet(nn.Module):
 
         if self.training:
             assert max_len <= self.max_seq_len, "Input length must be smaller than max_seq_len during training"
-            # set max_len to self.max_seq_len
-            max_len = self.max_seq_len
-            # batch input shape B, C, T
-            batch_shape = [len(feats), feats[0].shape[0], max_len]
-            batched_inputs = feats[0].new_full(batch_shape, padding_val)
+            if self.train_pad_to_max_seq_len:
+                # set max_len to self.max_seq_len
+                max_len = self.max_seq_len
+            else:
+                # pad to the longest sample, rounded up to the next divisible size
+                stride = self.max_div_factor
+                max_len = min((max_len + (stride - 1)) // stride * stride, self.max_seq_len)
+            # batch input shape B, C, T, padded in one go (B x T x C -> B x C x T)
+            # feats may arrive in a lower precision, always batch them in fp32
+            batched_inputs = pad_sequence([x.transpose(0, 1) for x in feats], batch_first=True,
+                                          padding_value=padding_val).transpose(1, 2)
+            batched_inputs = F.pad(batched_inputs, [0, max_len - batched_inputs.shape[-1]], value=padding_val)
+            batched_inputs = batched_inputs.to(torch.float32).contiguous()
 
             if self.additional_fature:
-                batch_add_shape = (len(additional_feats), additional_feats[0].shape[0], max_len)
-                batched_addfeat = additional_feats[0].new_full(batch_add_shape, 0.)
-
-                for feat, pad_feat, add_feat, pose_pad_feat in zip(feats, batched_inputs, additional_feats,
-                                                                   batched_addfeat):
-                    pad_feat[..., :feat.shape[-1]].copy_(feat)
-                    pose_pad_feat[..., :add_feat.shape[1]].copy_(add_feat)
-            else:
-                for feat, pad_feat in zip(feats, batched_inputs):
-                    pad_feat[..., :feat.shape[-1]].copy_(feat)
+                batched_addfeat = pad_sequence([x.transpose(0, 1) for x in additional_feats],
+                                               batch_first=True, padding_value=0.).transpose(1, 2)
+                batched_addfeat = F.pad(batched_addfeat, [0, max_len - batched_addfeat.shape[-1]], value=0.)
+                batched_addfeat = batched_addfeat.to(torch.float32).contiguous()
 
             if self.input_noise > 0:
                 noise = torch.randn_like(batched_inputs) * self.input_noise
@@ -619,16 +967,19 @@ class TriDet(nn.Module):
             # input length < self.max_seq_len, pad to max_seq_len
             if max_len <= self.max_seq_len:
                 max_len = self.max_seq_len
+            elif len(self.test_len_buckets) > 0 and max_len <= self.test_len_buckets[-1]:
+                # pad the input to the next length bucket (a few shapes, e.g., for compiled models)
+                max_len = min(b for b in self.test_len_buckets if b >= max_len)
             else:
                 # pad the input to the next divisible size
                 stride = self.max_div_factor
                 max_len = (max_len + (stride - 1)) // stride * stride
             padding_size = [0, max_len - feats_lens[0]]
-            batched_inputs = F.pad(feats[0], padding_size, value=padding_val).unsqueeze(0)
+            batched_inputs = F.pad(feats[0].float(), padding_size, value=padding_val).unsqueeze(0)
 
             if self.additional_fature:
                 pose_padding_size = [0, max_len - additional_frames_num[0]]
-                batched_addfeat = F.pad(additional_feats[0], pose_padding_size, value=padding_val).unsqueeze(0)
+                batched_addfeat = F.pad(additional_feats[0].float(), pose_padding_size, value=padding_val).unsqueeze(0)
 
         # generate the mask
         batched_masks = torch.arange(max_len, device=batched_inputs.device)[None, :] < feats_lens[:, None]
@@ -641,129 +992,90 @@ class TriDet(nn.Module):
 
         return batched_inputs, batched_masks, batched_addfeat
 
-    @torch.no_grad()
-    def label_points(self, points, gt_segments, gt_labels):
-        # concat points on all fpn levels List[T x 4] -> F T x 4
-        # This is shared for all samples in the mini-batch
-        num_levels = len(points)
-        concat_points = torch.cat(points, dim=0)
-        gt_cls, gt_offset = [], []
-
-        # loop over each video sample
-        for gt_segment, gt_label in zip(gt_segments, gt_labels):
-            cls_targets, reg_targets = self.label_points_single_video(
-                concat_points, gt_segment, gt_label
-            )
-            # append to list (len = # images, each of size FT x C)
-            gt_cls.append(cls_targets)
-            gt_offset.append(reg_targets)
-
-        return gt_cls, gt_offset
+    def concat_point_columns(self, points):
+        # the points only depend on the fpn lengths, cache their concatenation / columns
+        # (a small LRU cache, inference lengths vary from video to video)
+        key = (tuple(p.shape[0] for p in points), points[0].device, points[0].dtype)
+        concat_cols = self._concat_points_cache.get(key)
+        if concat_cols is None:
+            concat_cols = torch.cat(points, dim=0).t()[:, :, None].unbind(0)
+            self._concat_points_cache[key] = concat_cols
+            if len(self._concat_points_cache) > self.concat_points_cache_size:
+                self._concat_points_cache.popitem(last=False)
+        else:
+            self._concat_points_cache.move_to_end(key)
+        return concat_cols
 
     @torch.no_grad()
-    def label_points_single_video(self, concat_points, gt_segment, gt_label):
-        # concat_points : F T x 4 (t, regressoin range, stride)
-        # gt_segment : N (#Events) x 2
-        # gt_label : N (#Events) x 1
-        num_pts = concat_points.shape[0]
-        num_gts = gt_segment.shape[0]
-
-        # corner case where current sample does not have actions
-        if num_gts == 0:
-            cls_targets = gt_segment.new_full((num_pts, self.num_classes), 0)
-            reg_targets = gt_segment.new_zeros((num_pts, 2))
+    def label_points(self, points, gt_segments, gt_labels, num_gts):
+        # concat points on all fpn levels List[T x 4] -> F T x 4, split into F T x 1 columns
+        # This is shared for all samples in the mini-batch
+        # gt_segments : B x N (#Events, padded) x 2
+        # gt_labels : B x N (padded)
+        # num_gts : B (list), the number of actions of each video
+        pts, reg_lo, reg_hi, stride = self.concat_point_columns(points)
+        num_vids, max_gts = gt_labels.shape
+        num_pts = stride.shape[0]
+
+        # corner case where no sample has actions
+        if max_gts == 0:
+            cls_targets = gt_segments.new_zeros((num_vids, num_pts, self.num_classes))
+            if self.multi_label:
+                reg_targets = gt_segments.new_zeros((num_vids, num_pts, self.num_classes, 2))
+            else:
+                reg_targets = gt_segments.new_zeros((num_vids, num_pts, 2))
             return cls_targets, reg_targets
 
-        # compute the lengths of all segments -> F T x N
-        lens = gt_segment[:, 1] - gt_segment[:, 0]
-        lens = lens[None, :].repeat(num_pts, 1)
-
-        # compute the distance of every point to each segment boundary
-        # auto broadcasting for all reg target-> F T x N x2
-        gt_segs = gt_segment[None].expand(num_pts, num_gts, 2)
-        left = concat_points[:, 0, None] - gt_segs[:, :, 0]
-        right = gt_segs[:, :, 1] - concat_points[:, 0, None]
-        reg_targets = torch.stack((left, right), dim=-1)
-
-        if self.train_center_sample == 'radius':
-            # center of all segments F T x N
-            center_pts = 0.5 * (gt_segs[:, :, 0] + gt_segs[:, :, 1])
-            # center sampling based on stride radius
-            # compute the new boundaries:
-            # concat_points[:, 3] stores the stride
-            t_mins = \
-                center_pts - concat_points[:, 3, None] * self.train_center_sample_radius
-            t_maxs = \
-                center_pts + concat_points[:, 3, None] * self.train_center_sample_radius
-            # prevent t_mins / maxs from over-running the action boundary
-            # left: torch.maximum(t_mins, gt_segs[:, :, 0])
-            # right: torch.minimum(t_maxs, gt_segs[:, :, 1])
-            # F T x N (distance to the new boundary)
-            cb_dist_left = concat_points[:, 0, None] - torch.maximum(t_mins, gt_segs[:, :, 0])
-            cb_dist_right = torch.minimum(t_maxs, gt_segs[:, :, 1]) - concat_points[:, 0, None]
-            # F T x N x 2
-            center_seg = torch.stack((cb_dist_left, cb_dist_right), -1)
-            # F T x N
-            inside_gt_seg_mask = center_seg.min(-1)[0] > 0
-
-        else:
-            # inside an gt action
-            inside_gt_seg_mask = reg_targets.min(-1)[0] > 0
-
-        # limit the regression range for each location
-        max_regress_distance = reg_targets.max(-1)[0]
-        # F T x N
-        inside_regress_range = torch.logical_and(
-            (max_regress_distance >= concat_points[:, 1, None]),
-            (max_regress_distance <= concat_points[:, 2, None])
-        )
+        num_gts = torch.as_tensor(num_gts, device=gt_labels.device)
+        gt_valid = torch.arange(max_gts, device=gt_labels.device)[None, :] < num_gts[:, None]
 
+        # regression targets B x F T x N x 2, and the lengths of all segments B x F T x N
         # if there are still more than one actions for one moment
         # pick the one with the shortest duration (easiest to regress)
-        lens.masked_fill_(inside_gt_seg_mask == 0, float('inf'))
-        lens.masked_fill_(inside_regress_range == 0, float('inf'))
+        reg_targets, lens = assign_points_to_segments(
+            pts, reg_lo, reg_hi, stride, gt_segments, gt_valid,
+            self.train_center_sample == 'radius', float(self.train_center_sample_radius)
+        )
+        # cls_targets: B x F T x C, set to 1 at the (point, label) pairs of the assigned actions
+        # (duplicated pairs, i.e. GT actions with the same label, are simply set twice)
+        cls_targets = reg_targets.new_zeros((num_vids, num_pts, self.num_classes))
 
         if self.multi_label:
-            len_mask = (lens < float('inf')).to(reg_targets.dtype)  # FT x N
-
-            # cls_targets: F T x C; reg_targets F T x C x 2
-            gt_label_one_hot = F.one_hot(gt_label, self.num_classes).to(reg_targets.dtype)  # N x C
-            cls_targets = len_mask @ gt_label_one_hot
-            # to prevent multiple GT actions with the same label and boundaries
-            cls_targets.clamp_(min=0.0, max=1.0)
-            # FT x N x 2  --> FT x C x 2
-            len_mask = len_mask.bool()
-            pos_t_idx, pos_gt_idx = torch.where(len_mask > 0)
-            pos_cls_idx = gt_label[pos_gt_idx]
-            multi_target = torch.zeros((num_pts, self.num_classes, 2), device=reg_targets.device)
-            multi_target[pos_t_idx, pos_cls_idx] = reg_targets[pos_t_idx, pos_gt_idx]
+            len_mask = lens < float('inf')  # B x FT x N
+
+            # reg_targets B x F T x C x 2
+            pos_vid_idx, pos_t_idx, pos_gt_idx = torch.where(len_mask)
+            pos_cls_idx = gt_labels[pos_vid_idx, pos_gt_idx]
+            cls_targets[pos_vid_idx, pos_t_idx, pos_cls_idx] = 1.0
+            # B x FT x N x 2  --> B x FT x C x 2
+            multi_target = reg_targets.new_zeros((num_vids, num_pts, self.num_classes, 2))
+            multi_target[pos_vid_idx, pos_t_idx, pos_cls_idx] = reg_targets[pos_vid_idx, pos_t_idx, pos_gt_idx]
             # normalization based on stride
-            multi_target /= concat_points[:, 3, None, None]
+            multi_target /= stride[:, :, None]
 
             return cls_targets, multi_target
 
-
         else:
-            # F T x N -> F T
-            min_len, min_len_inds = lens.min(dim=1)
+            # B x F T x N -> B x F T
+            min_len, min_len_inds = lens.min(dim=2)
 
             # corner case: multiple actions with very similar durations (e.g., THUMOS14)
             min_len_mask = torch.logical_and(
-                (lens <= (min_len[:, None] + 1e-3)), (lens < float('inf'))
-            ).to(reg_targets.dtype)
+                (lens <= (min_len[:, :, None] + 1e-3)), (lens < float('inf'))
+            )
 
-            # cls_targets: F T x C; reg_targets F T x 2
-            gt_label_one_hot = F.one_hot(
-                gt_label, self.num_classes
-            ).to(reg_targets.dtype)
-            cls_targets = min_len_mask @ gt_label_one_hot
+            # reg_targets B x F T x 2
+            pos_vid_idx, pos_t_idx, pos_gt_idx = torch.where(min_len_mask)
+            cls_targets[pos_vid_idx, pos_t_idx, gt_labels[pos_vid_idx, pos_gt_idx]] = 1.0
 
-            # to prevent multiple GT actions with the same label and boundaries
-            cls_targets.clamp_(min=0.0, max=1.0)
             # OK to use min_len_inds
-            reg_targets = reg_targets[range(num_pts), min_len_inds]
+            reg_targets = reg_targets.gather(
+                2, min_len_inds[:, :, None, None].expand(-1, -1, 1, 2)
+            ).squeeze(2)
             # normalization based on stride
-            reg_targets /= concat_points[:, 3, None]
+            reg_targets /= stride
+            # videos without actions
+            reg_targets.masked_fill_((num_gts == 0)[:, None, None], 0)
 
         return cls_targets, reg_targets
 
@@ -771,73 +1083,68 @@ class TriDet(nn.Module):
             self, fpn_masks,
             out_cls_logits, out_offsets,
             gt_cls_labels, gt_offsets,
-            out_start, out_end,
+            out_bd_logits,
     ):
-        # fpn_masks, out_*: F (List) [B, T_i, C]
-        # gt_* : B (list) [F T, C]
-        # fpn_masks -> (B, FT)
-        valid_mask = torch.cat(fpn_masks, dim=1)
+        # fpn_masks: (B, FT), out_*: [B, FT, C] (all levels concatenated)
+        # out_bd_logits: F (List) [B, 2C (start | end), T_i]
+        # gt_* : [B, F T, C] (batched by label_points)
+        valid_mask = fpn_masks
 
         if self.use_trident_head:
-            out_start_logits = []
-            out_end_logits = []
-            for i in range(len(out_start)):
-                x = (F.pad(out_start[i], (self.num_bins, 0), mode='constant', value=0)).unsqueeze(-1)  # pad left
-                x_size = list(x.size())  # bz, cls_num, T+num_bins, 1
-                x_size[-1] = self.num_bins + 1  # bz, cls_num, T+num_bins, num_bins + 1
-                x_size[-2] = x_size[-2] - self.num_bins  # bz, cls_num, T+num_bins, num_bins + 1
-                x_stride = list(x.stride())
-                x_stride[-2] = x_stride[-1]
-
-                x = x.as_strided(size=x_size, stride=x_stride)
-                out_start_logits.append(x.permute(0, 2, 1, 3))
-
-                x = (F.pad(out_end[i], (0, self.num_bins), mode='constant', value=0)).unsqueeze(-1)  # pad right
-                x = x.as_strided(size=x_size, stride=x_stride)
-                out_end_logits.append(x.permute(0, 2, 1, 3))
+            # bz, cls_num, FT, num_bins + 1 -> bz, FT, cls_num, num_bins + 1
+            out_start_logits, out_end_logits = unfold_bins_levels(out_bd_logits, self.num_bins)
+            out_start_logits = out_start_logits.permute(0, 2, 1, 3)
+            out_end_logits = out_end_logits.permute(0, 2, 1, 3)
         else:
             out_start_logits = None
             out_end_logits = None
 
         # 1. classification loss
-        # stack the list -> (B, FT) -> (# Valid, )
-        gt_cls = torch.stack(gt_cls_labels)
+        # (B, FT) -> (# Valid, )
+        gt_cls = gt_cls_labels
         if self.multi_label:
-            pos_mask = torch.logical_and((gt_cls > 0), valid_mask.unsqueeze(-1))
+            pos_mask = _pos_mask_multi(gt_cls, valid_mask)
         else:
-            pos_mask = torch.logical_and((gt_cls.sum(-1) > 0), valid_mask)
+            pos_mask = _pos_mask_single(gt_cls, valid_mask)
 
         decoded_offsets = self.decode_offset(out_offsets, out_start_logits, out_end_logits)  # bz, stack_T, num_class, 2
-        decoded_offsets = decoded_offsets[pos_mask]
 
         if self.use_trident_head:
-            # the boundary head predicts the classification score for each categories.
-            pred_offsets = decoded_offsets[gt_cls[pos_mask].bool()]
-            # cat the predicted offsets -> (B, FT, 2 (xC)) -> # (#Pos, 2 (xC))
-            vid = torch.where(gt_cls[pos_mask])[0]
-            gt_offsets = torch.stack(gt_offsets)[pos_mask][vid]
+            # the boundary head predicts the offsets for each categories.
+            # gather the (video, point, class) of all positives at once -> (#Pos, 2)
+            if self.multi_label:
+                pos_vid, pos_t, pos_cls = pos_mask.nonzero(as_tuple=True)
+                gt_offsets = gt_offsets[pos_vid, pos_t, pos_cls]
+            else:
+                pos_vid, pos_t, pos_cls = _pos_mask_multi(gt_cls, valid_mask).nonzero(as_tuple=True)
+                gt_offsets = gt_offsets[pos_vid, pos_t]
+            pred_offsets = decoded_offsets[pos_vid, pos_t, pos_cls]
         else:
-            pred_offsets = decoded_offsets
-            gt_offsets = torch.stack(gt_offsets)[pos_mask]
-
-        # update the loss normalizer
-        num_pos = pos_mask.sum().item()
-        self.loss_normalizer = self.loss_normalizer_momentum * self.loss_normalizer + (
-                1 - self.loss_normalizer_momentum
-        ) * max(num_pos, 1)
+            # one nonzero shared by the predictions and the targets
+            pos_idx = pos_mask.nonzero(as_tuple=True)
+            pred_offsets = decoded_offsets[pos_idx]
+            gt_offsets = gt_offsets[pos_idx]
+
+        # update the loss normalizer (on device, no sync)
+        # DataParallel replicas do not update it: the replica on the first device shares the buffer of the
+        # model, and would write an EMA of its own share of the batch only (the updates of the other replicas
+        # are discarded). As with the former python float, the normalizer stays at init_loss_norm with DataParallel
+        if not getattr(self, '_is_replica', False):
+            num_pos = pos_mask.sum()
+            self.loss_normalizer.mul_(self.loss_normalizer_momentum).add_(
+                (1 - self.loss_normalizer_momentum) * num_pos.clamp(min=1)
+            )
 
         # gt_cls is already one hot encoded now, simply masking out
         gt_target = gt_cls[valid_mask]
 
-        # optinal label smoothing
-        gt_target *= 1 - self.train_label_smoothing
-        gt_target += self.train_label_smoothing / (self.num_classes + 1)
-
-        # focal loss
+        # focal loss (summed directly, no per-element loss is kept), with the optinal label smoothing
         cls_loss = sigmoid_focal_loss(
-            torch.cat(out_cls_logits, dim=1)[valid_mask],
+            out_cls_logits[valid_mask],
             gt_target,
-            reduction='none'
+            reduction='sum',
+            ls_scale=self.train_ls_scale,
+            ls_bias=self.train_ls_bias
         )
 
         if self.use_trident_head:
@@ -847,28 +1154,32 @@ class TriDet(nn.Module):
                 gt_offsets,
                 reduction='none'
             )
-            rated_mask = gt_target > self.train_label_smoothing / (self.num_classes + 1)
-            cls_loss[rated_mask] *= (1 - iou_rate) ** self.iou_weight_power
+            # only the positives are re-weighted: add (weight - 1) x their loss to the sum
+            # the positives are gathered with the (video, point, class) indices of the offsets (same order)
+            rated_loss = sigmoid_focal_loss(
+                out_cls_logits[pos_vid, pos_t, pos_cls],
+                gt_cls[pos_vid, pos_t, pos_cls],
+                reduction='none',
+                ls_scale=self.train_ls_scale,
+                ls_bias=self.train_ls_bias
+            )
+            cls_loss = cls_loss + (rated_loss * ((1 - iou_rate) ** self.iou_weight_power - 1)).sum()
 
-        cls_loss = cls_loss.sum()
         cls_loss /= self.loss_normalizer
 
         # 2. regression using IoU/GIoU loss (defined on positive samples)
-        if num_pos == 0:
-            reg_loss = 0 * pred_offsets.sum()
-        else:
-            # giou loss defined on positive samples
-            reg_loss = ctr_diou_loss_1d(
-                pred_offsets,
-                gt_offsets,
-                reduction='sum'
-            )
-            reg_loss /= self.loss_normalizer
+        # giou loss defined on positive samples (zero if there is none)
+        reg_loss = ctr_diou_loss_1d(
+            pred_offsets,
+            gt_offsets,
+            reduction='sum'
+        )
+        reg_loss /= self.loss_normalizer
 
         if self.train_loss_weight > 0:
             loss_weight = self.train_loss_weight
         else:
-            loss_weight = cls_loss.detach() / max(reg_loss.item(), 0.01)
+            loss_weight = cls_loss.detach() / reg_loss.detach().clamp(min=0.01)
 
         # return a dict of losses
         final_loss = cls_loss + reg_loss * loss_weight
@@ -882,11 +1193,12 @@ class TriDet(nn.Module):
             video_list,
             points, fpn_masks,
             out_cls_logits, out_offsets,
-            out_lb_logits, out_rb_logits,
+            out_bd_logits,
     ):
         # video_list B (list) [dict]
         # points F (list) [T_i, 4]
-        # fpn_masks, out_*: F (List) [B, T_i, C]
+        # fpn_masks: [B, FT], out_*: [B, FT, C] (all levels concatenated)
+        # out_bd_logits: F (List) [B, 2C (start | end), T_i]
         results = []
 
         # 1: gather video meta information
@@ -898,26 +1210,26 @@ class TriDet(nn.Module):
 
         # 2: inference on each single video and gather the results
         # upto this point, all results use timestamps defined on feature grids
+        # (no boundary logits without the Trident-head, one tuple shared by all videos)
+        none_levels = (None,) * len(points)
         for idx, (vidx, fps, vlen, stride, nframes) in enumerate(
                 zip(vid_idxs, vid_fps, vid_lens, vid_ft_stride, vid_ft_nframes)
         ):
             # gather per-video outputs
-            cls_logits_per_vid = [x[idx] for x in out_cls_logits]
-            offsets_per_vid = [x[idx] for x in out_offsets]
-            fpn_masks_per_vid = [x[idx] for x in fpn_masks]
+            cls_logits_per_vid = out_cls_logits[idx]
+            offsets_per_vid = out_offsets[idx]
+            fpn_masks_per_vid = fpn_masks[idx]
 
             if self.use_trident_head:
-                lb_logits_per_vid = [x[idx] for x in out_lb_logits]
-                rb_logits_per_vid = [x[idx] for x in out_rb_logits]
+                bd_logits_per_vid = [x[idx] for x in out_bd_logits]
             else:
-                lb_logits_per_vid = [None for x in range(len(out_cls_logits))]
-                rb_logits_per_vid = [None for x in range(len(out_cls_logits))]
+                bd_logits_per_vid = none_levels
 
             # inference on a single video (should always be the case)
             results_per_vid = self.inference_single_video(
                 points, fpn_masks_per_vid,
                 cls_logits_per_vid, offsets_per_vid,
-                lb_logits_per_vid, rb_logits_per_vid
+                bd_logits_per_vid
             )
             # pass through video meta info
             results_per_vid['video_id'] = vidx
@@ -939,125 +1251,126 @@ class TriDet(nn.Module):
             fpn_masks,
             out_cls_logits,
             out_offsets,
-            lb_logits_per_vid, rb_logits_per_vid
+            bd_logits_per_vid
     ):
         # points F (list) [T_i, 4]
-        # fpn_masks, out_*: F (List) [T_i, C]
-        segs_all = []
-        scores_all = []
-        cls_idxs_all = []
-
-        # loop over fpn levels
-        for cls_i, offsets_i, pts_i, mask_i, lb_cls_i, rb_cls_i in zip(
-                out_cls_logits, out_offsets, points, fpn_masks, lb_logits_per_vid, rb_logits_per_vid
-        ):
-            pred_prob = (cls_i.sigmoid() * mask_i.unsqueeze(-1)).flatten()
-
-            # Apply filtering to make NMS faster following detectron2
-            # 1. Keep seg with confidence score > a threshold
-            keep_idxs1 = (pred_prob > self.test_pre_nms_thresh)
-            pred_prob = pred_prob[keep_idxs1]
-            topk_idxs = keep_idxs1.nonzero(as_tuple=True)[0]
-
-            # 2. Keep top k top scoring boxes only
-            num_topk = min(self.test_pre_nms_topk, topk_idxs.size(0))
-            pred_prob, idxs = pred_prob.sort(descending=True)
-            pred_prob = pred_prob[:num_topk].clone()
-            topk_idxs = topk_idxs[idxs[:num_topk]].clone()
-
-            # fix a warning in pytorch 1.9
-            pt_idxs = torch.div(
-                topk_idxs, self.num_classes, rounding_mode='floor'
-            )
-            cls_idxs = torch.fmod(topk_idxs, self.num_classes)
+        # fpn_masks: [FT], out_*: [FT, C] (all levels concatenated)
+        # bd_logits_per_vid: F (list) [2C (start | end), T_i] (or None)
+        fpn_sizes = [pts_i.shape[0] for pts_i in points]
+        pts_t, _, _, pts_stride = self.concat_point_columns(points)
 
-            if self.use_trident_head:
-                # pad the boarder
-                x = (F.pad(lb_cls_i, (self.num_bins, 0), mode='constant', value=0)).unsqueeze(-1)  # pad left
-                x_size = list(x.size())  # cls_num, T+num_bins, 1
-                x_size[-1] = self.num_bins + 1
-                x_size[-2] = x_size[-2] - self.num_bins  # cls_num, T, num_bins + 1
-                x_stride = list(x.stride())
-                x_stride[-2] = x_stride[-1]
-
-                left = x.as_strided(size=x_size, stride=x_stride)
-
-                x = (F.pad(rb_cls_i, (0, self.num_bins), mode='constant', value=0)).unsqueeze(-1)  # pad right
-                right = x.as_strided(size=x_size, stride=x_stride)  # T, cls_num, num_bins
-                if self.multi_label:
-                    left = left.transpose(0, 1)  # T, cls_num, num_bins
-                    right = right.transpose(0, 1)  # T, cls_num, num_bins
-            else:
-                left = None
-                right = None
+        # the scores / decoded offsets of all levels at once
+        pred_prob_all = out_cls_logits.sigmoid() * fpn_masks.unsqueeze(-1)
+        if self.use_trident_head:
+            # pad the boarder, cls_num, FT, num_bins + 1 -> FT, cls_num, num_bins + 1
+            left, right = unfold_bins_levels(bd_logits_per_vid, self.num_bins)
+            left, right = left.transpose(0, 1), right.transpose(0, 1)
+        else:
+            left = None
+            right = None
+        decoded_offsets = self.decode_offset(out_offsets, left, right)
+
+        # select the candidates of all levels at once, without a loop / host sync per level:
+        # the flattened scores of each level are one row of F x max(T_i C), padded by -1
+        pred_prob_levels = pad_sequence(
+            [pred_prob.flatten() for pred_prob in torch.split(pred_prob_all, fpn_sizes, dim=0)],
+            batch_first=True, padding_value=-1.0
+        )
+        level_starts = [0]
+        for fpn_size in fpn_sizes[:-1]:
+            level_starts.append(level_starts[-1] + fpn_size * self.num_classes)
+
+        # Apply filtering to make NMS faster following detectron2
+        # 1. Keep top k top scoring boxes only (per level)
+        num_topk = min(self.test_pre_nms_topk, pred_prob_levels.shape[1])
+        pred_prob, topk_idxs = pred_prob_levels.topk(num_topk, dim=1, sorted=True)
+        # indices over all levels
+        topk_idxs += torch.as_tensor(level_starts, device=topk_idxs.device)[:, None]
+
+        # 2. Keep seg with confidence score > a threshold
+        # (the top k of all scores over the threshold, same as the top k after thresholding)
+        # cat along the FPN levels (F N_i)
+        keep_idxs1 = (pred_prob > self.test_pre_nms_thresh)
+        pred_prob = pred_prob[keep_idxs1]
+        topk_idxs = topk_idxs[keep_idxs1]
+
+        # fix a warning in pytorch 1.9
+        pt_idxs = torch.div(
+            topk_idxs, self.num_classes, rounding_mode='floor'
+        )
+        # the remainder from the quotient (no second division)
+        cls_idxs = topk_idxs - pt_idxs * self.num_classes
 
-            decoded_offsets = self.decode_offset(offsets_i, left, right)
+        # 3. gather the offsets of the candidates
+        if self.multi_label or self.use_trident_head:
+            offsets = decoded_offsets[pt_idxs, cls_idxs]
+        else:
+            offsets = decoded_offsets[pt_idxs]
+        pts = pts_t[pt_idxs, 0]
+        stride = pts_stride[pt_idxs, 0]
 
-            if self.multi_label:
-                if self.use_trident_head:
-                    offsets = decoded_offsets[pt_idxs, cls_idxs]
-                else:
-                    offsets = decoded_offsets[pt_idxs, cls_idxs]
-            else:
-                if self.use_trident_head:
-                    offsets = decoded_offsets[cls_idxs, pt_idxs]
-                else:
-                    offsets = decoded_offsets[pt_idxs]
-            pts = pts_i[pt_idxs]
-
-            # 4. compute predicted segments (denorm by stride for output offsets)
-            seg_left = pts[:, 0] - offsets[:, 0] * pts[:, 3]
-            seg_right = pts[:, 0] + offsets[:, 1] * pts[:, 3]
-
-            pred_segs = torch.stack((seg_left, seg_right), -1)
-
-            # 5. Keep seg with duration > a threshold (relative to feature grids)
-            seg_areas = seg_right - seg_left
-            keep_idxs2 = seg_areas > self.test_duration_thresh
-
-            # *_all : N (filtered # of segments) x 2 / 1
-            segs_all.append(pred_segs[keep_idxs2])
-            scores_all.append(pred_prob[keep_idxs2])
-            cls_idxs_all.append(cls_idxs[keep_idxs2])
-
-        # cat along the FPN levels (F N_i, C)
-        segs_all, scores_all, cls_idxs_all = [
-            torch.cat(x) for x in [segs_all, scores_all, cls_idxs_all]
-        ]
-        results = {'segments': segs_all,
-                   'scores': scores_all,
-                   'labels': cls_idxs_all}
+        # 4. compute predicted segments (denorm by stride for output offsets)
+        pred_segs, seg_areas = _decode_segs(pts, stride, offsets)
+
+        # 5. Keep seg with duration > a threshold (relative to feature grids)
+        keep_idxs2 = seg_areas > self.test_duration_thresh
+
+        # N (filtered # of segments) x 2 / 1
+        results = {'segments': pred_segs[keep_idxs2],
+                   'scores': pred_prob[keep_idxs2],
+                   'labels': cls_idxs[keep_idxs2]}
 
         return results
 
+    @torch.no_grad()
+    def nms(self, segs, scores, labels):
+        # batched nms of the results of a single video
+        return batched_nms(
+            segs, scores, labels,
+            self.test_iou_threshold,
+            self.test_min_score,
+            self.test_max_seg_num,
+            use_soft_nms=(self.test_nms_method == 'soft'),
+            multiclass=self.test_multiclass_nms,
+            sigma=self.test_nms_sigma,
+            voting_thresh=self.test_voting_thresh
+        )
+
     @torch.no_grad()
     def postprocessing(self, results):
         # input : list of dictionary items
         # (1) push to CPU; (2) NMS; (3) convert to actual time stamps
         processed_results = []
-        for results_per_vid in results:
+        if len(results) == 0:
+            return processed_results
+        dets = [(results_per_vid['segments'], results_per_vid['scores'], results_per_vid['labels'])
+                for results_per_vid in results]
+        # hard nms runs on the device of the results (before the copy), soft nms is only implemented on CPU
+        nms_before_copy = (self.test_nms_method == 'hard')
+        if nms_before_copy:
+            dets = [self.nms(*dets_per_vid) for dets_per_vid in dets]
+
+        # 1: move the results of all videos to CPU with a single copy (segments | score | label)
+        num_segs = [scores.shape[0] for _, scores, _ in dets]
+        packed = torch.cat([
+            torch.cat((segs, scores[:, None], labels[:, None].to(scores.dtype)), dim=1)
+            for segs, scores, labels in dets
+        ]).detach().cpu()
+        label_dtype = results[0]['labels'].dtype
+        for results_per_vid, packed_per_vid in zip(results, packed.split(num_segs)):
             # unpack the meta info
             vidx = results_per_vid['video_id']
             fps = results_per_vid['fps']
             vlen = results_per_vid['duration']
             stride = results_per_vid['feat_stride']
             nframes = results_per_vid['feat_num_frames']
-            # 1: unpack the results and move to CPU
-            segs = results_per_vid['segments'].detach().cpu()
-            scores = results_per_vid['scores'].detach().cpu()
-            labels = results_per_vid['labels'].detach().cpu()
-            if self.test_nms_method != 'none':
-                # 2: batched nms (only implemented on CPU)
-                segs, scores, labels = batched_nms(
-                    segs, scores, labels,
-                    self.test_iou_threshold,
-                    self.test_min_score,
-                    self.test_max_seg_num,
-                    use_soft_nms=(self.test_nms_method == 'soft'),
-                    multiclass=self.test_multiclass_nms,
-                    sigma=self.test_nms_sigma,
-                    voting_thresh=self.test_voting_thresh
-                )
+            # unpack the results
+            segs = packed_per_vid[:, :2].contiguous()
+            scores = packed_per_vid[:, 2].contiguous()
+            labels = packed_per_vid[:, 3].to(label_dtype)
+            if self.test_nms_method != 'none' and not nms_before_copy:
+                # 2: batched nms (on CPU)
+                segs, scores, labels = self.nms(segs, scores, labels)
             # 3: convert from feature grids to seconds
             if segs.shape[0] > 0:
                 segs = (segs * stride + 0.5 * nframes) / fps
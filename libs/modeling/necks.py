@@ -80,14 +80,13 @@ class FPN1D(nn.Module):
 
         # fpn conv / norm -> outputs
         # mask will remain the same
-        fpn_feats = tuple()
+        fpn_feats = [None] * used_backbone_levels
         for i in range(used_backbone_levels):
             x, _ = self.fpn_convs[i](
                 laterals[i], fpn_masks[i + self.start_level])
-            x = self.fpn_norms[i](x)
-            fpn_feats += (x, )
+            fpn_feats[i] = self.fpn_norms[i](x)
 
-        return fpn_feats, fpn_masks
+        return tuple(fpn_feats), fpn_masks
 
 @register_neck('identity')
 class FPNIdentity(nn.Module):
@@ -131,9 +130,8 @@ class FPNIdentity(nn.Module):
         assert len(fpn_masks) ==  len(self.in_channels)
 
         # apply norms, fpn_masks will remain the same with 1x1 convs
-        fpn_feats = tuple()
+        fpn_feats = [None] * len(self.fpn_norms)
         for i in range(len(self.fpn_norms)):
-            x = self.fpn_norms[i](inputs[i + self.start_level])
-            fpn_feats += (x, )
+            fpn_feats[i] = self.fpn_norms[i](inputs[i + self.start_level])
 
-        return fpn_feats, fpn_masks
+        return tuple(fpn_feats), fpn_masks
@@ -1,16 +1,64 @@
 # Functions for 1D NMS, modified from:
 # https://github.com/open-mmlab/mmcv/blob/master/mmcv/ops/nms.py
+import math
+
 import torch
 
 import nms_1d_cpu
 
+# max #segs for the (quadratic memory) nms with tensor ops, larger inputs are moved to CPU
+MAX_NUM_SEGS_TENSOR_NMS = 4096
+
+
+def nms_1d_tensor(segs, scores, iou_threshold, cls_idxs=None):
+    """
+        Greedy 1D NMS with tensor ops (e.g., on GPUs), same outputs as nms_1d_cpu.nms.
+        The greedy result is the fixed point of "keep a seg if no kept seg with a higher score
+        overlaps it", which is reached from keeping all segs in a few iterations (as in Cluster-NMS).
+        If cls_idxs is given, segs only suppress the segs of the same class (all classes at once)
+    """
+    # sort by descending scores, segs: N x 2
+    order = scores.sort(descending=True)[1]
+    segs = segs[order]
+    areas = segs[:, 1] - segs[:, 0] + 1e-6
+
+    # iou between all pairs of segs: N x N
+    left = torch.maximum(segs[:, None, 0], segs[None, :, 0])
+    right = torch.minimum(segs[:, None, 1], segs[None, :, 1])
+    inter = (right - left).clamp(min=0)
+    iou = inter / (areas[:, None] + areas[None, :] - inter)
+
+    # suppress[i, j]: seg i suppresses seg j (with a lower score) if seg i is kept
+    suppress = torch.triu(iou >= iou_threshold, diagonal=1)
+    if cls_idxs is not None:
+        cls_idxs = cls_idxs[order]
+        suppress &= cls_idxs[:, None] == cls_idxs[None, :]
+
+    # after k iterations the first k segs are final, so the fixed point is reached within N iterations.
+    # the iterations run in blocks of ~log2(N), and only the last one of a block checks for convergence
+    # (a host sync), usually a single check in total
+    num_segs = order.shape[0]
+    block = max(1, math.ceil(math.log2(num_segs + 1)))
+    keep = torch.ones_like(order, dtype=torch.bool)
+    num_iters = 0
+    while True:
+        for _ in range(block - 1):
+            keep = torch.logical_not(torch.any(suppress & keep[:, None], dim=0))
+        new_keep = torch.logical_not(torch.any(suppress & keep[:, None], dim=0))
+        num_iters += block
+        if num_iters >= num_segs or torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return order[new_keep]
+
 
 class NMSop(torch.autograd.Function):
     @staticmethod
     def forward(
         ctx, segs, scores, cls_idxs,
-        iou_threshold, min_score, max_num
+        iou_threshold, min_score, max_num, class_batched=False
     ):
+        # class_batched: nms of all classes at once (with tensor ops), segs only suppress the same class
         # vanilla nms will not change the score, so we can filter segs first
         is_filtering_by_score = (min_score > 0)
         if is_filtering_by_score:
@@ -21,10 +69,16 @@ class NMSop(torch.autograd.Function):
                 valid_mask, as_tuple=False).squeeze(dim=1)
 
         # nms op; return inds that is sorted by descending order
-        inds = nms_1d_cpu.nms(
-            segs.contiguous().cpu(),
-            scores.contiguous().cpu(),
-            iou_threshold=float(iou_threshold))
+        if class_batched:
+            inds = nms_1d_tensor(segs, scores, float(iou_threshold), cls_idxs)
+        elif segs.is_cuda and segs.shape[0] <= MAX_NUM_SEGS_TENSOR_NMS:
+            # stay on the device
+            inds = nms_1d_tensor(segs, scores, float(iou_threshold))
+        else:
+            inds = nms_1d_cpu.nms(
+                segs.contiguous().cpu(),
+                scores.contiguous().cpu(),
+                iou_threshold=float(iou_threshold)).to(segs.device)
         # cap by max number
         if max_num > 0:
             inds = inds[:min(max_num, len(inds))]
@@ -116,11 +170,19 @@ def batched_nms(
     num_segs = segs.shape[0]
     # corner case, no prediction outputs
     if num_segs == 0:
-        return torch.zeros([0, 2]),\
-               torch.zeros([0,]),\
-               torch.zeros([0,], dtype=cls_idxs.dtype)
-
-    if multiclass:
+        return segs.new_zeros([0, 2]),\
+               scores.new_zeros([0,]),\
+               cls_idxs.new_zeros([0,])
+
+    if multiclass and not use_soft_nms and segs.is_cuda and num_segs <= MAX_NUM_SEGS_TENSOR_NMS:
+        # multiclass nms on the device: all classes in one nms (no suppression across classes),
+        # without a loop / host sync per class. The per-class cap of max_seg_num is not needed,
+        # the results are capped to the top max_seg_num scores of all classes below
+        new_segs, new_scores, new_cls_idxs = NMSop.apply(
+            segs, scores, cls_idxs, iou_threshold, min_score, max_seg_num, True
+        )
+
+    elif multiclass:
         # multiclass nms: apply nms on each class independently
         new_segs, new_scores, new_cls_idxs = [], [], []
         for class_id in torch.unique(cls_idxs):